@@ -0,0 +1,303 @@
+import os
+import os.path as path
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from contextlib import contextmanager
+
+import gitorious2gitlab.gitorious as gitorious
+from gitorious2gitlab.claims import shard_of, ClaimStore, CLAIMED, TAKEN_OVER
+from gitorious2gitlab.importer import RepositoryGraph, RepositoryGroup, UnmigratedRepositoryError
+from gitorious2gitlab.mysqldump import DumpLoader, parse_rows
+from gitorious2gitlab.planner import Plan, PlanEntry
+from gitorious2gitlab.workspace import Workspace
+
+# Small behaviour checks for the parts the benchmarks do not exercise with realistic input.
+# Run them with python -m benchmarks.checks; the exit status is the number of failed checks.
+
+DUMP = r'''-- MySQL dump 10.13
+DROP TABLE IF EXISTS `users`;
+CREATE TABLE `users` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `login` varchar(255) DEFAULT NULL,
+  `crypted_password` varchar(40) DEFAULT NULL,
+  `email` varchar(255) DEFAULT NULL,
+  `fullname` varchar(255) DEFAULT NULL,
+  `created_at` datetime DEFAULT NULL,
+  `avatar` blob,
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+INSERT INTO `users` VALUES (1,'alice','x','alice@example.com','Alice \'Al\' O''Neil','2009-01-02 03:04:05',_binary 0x00FF),(2,'bob\\dev',NULL,_binary 0x626F62406578616D706C652E636F6D,'Bob\nSmith, (Jr.)','0000-00-00 00:00:00',NULL);
+INSERT INTO `tags` (`id`, `name`, `kind`) VALUES (1,'ruby',-1),(2,'c;(x)',2.5e3);
+CREATE TABLE `taggings` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `tag_id` int(11) DEFAULT NULL,
+  `taggable_id` int(11) DEFAULT NULL,
+  `taggable_type` varchar(255) DEFAULT NULL,
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+INSERT INTO `taggings` VALUES (1,1,10,'Project'),(2,2,10,'User'),(3,2,11,'Project');
+INSERT INTO `unmodeled` VALUES (1,'ignored');
+'''
+
+@contextmanager
+def temporary_directory():
+    directory = tempfile.mkdtemp(prefix='g2g-checks-')
+    try:
+        yield directory
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+@contextmanager
+def loaded_dump(dump):
+    with temporary_directory() as directory:
+        path_to_db = path.join(directory, 'gitorious.sqlite')
+        counts = DumpLoader(path_to_db, batch_size=1).load(dump.splitlines(True))
+        db = sqlite3.connect(path_to_db)
+        try:
+            yield (db, counts)
+        finally:
+            db.close()
+
+def check_parse_rows():
+    rows = list(parse_rows(r"(1,'a\'b''c',NULL,0x4869,_binary 'd\\e',-2,1.5),(2,'(),;','',0x,_binary 0x00,0,1e3);"))
+    assert rows == [[1, "a'b'c", None, 'Hi', 'd\\e', -2, 1.5],
+                    [2, '(),;', '', '', '\0', 0, 1000.0]], rows
+
+def check_dump_values():
+    with loaded_dump(DUMP) as (db, counts):
+        users = db.execute('SELECT id, login, email, fullname, created_at FROM users ORDER BY id').fetchall()
+        assert users == [(1, 'alice', 'alice@example.com', "Alice 'Al' O'Neil", '2009-01-02 03:04:05'),
+                         (2, 'bob\\dev', 'bob@example.com', 'Bob\nSmith, (Jr.)', None)], users
+        # no CREATE TABLE for tags: the INSERT's own column list is used
+        tags = db.execute('SELECT id, name FROM tags ORDER BY id').fetchall()
+        assert tags == [(1, 'ruby'), (2, 'c;(x)')], tags
+        assert counts['users'] == 2 and counts['tags'] == 2, counts
+
+def check_taggings_filter():
+    with loaded_dump(DUMP) as (db, counts):
+        taggings = db.execute('SELECT id, tag_id, taggable_id FROM taggings ORDER BY id').fetchall()
+        assert taggings == [(1, 1, 10), (3, 2, 11)], taggings
+        assert counts['taggings'] == 2, counts
+
+def check_claim_takeover():
+    with temporary_directory() as directory:
+        url = path.join(directory, 'claims.sqlite')
+        (alive, dead, other) = (ClaimStore(url, owner, ttl=0.5) for owner in ('alive', 'dead', 'other'))
+        assert alive.claim(1) == CLAIMED and dead.claim(2) == CLAIMED and dead.claim(3) == CLAIMED
+        dead.record_created(2, 'Project', 2, 'group', 42)
+        assert not other.claim(1) and not other.claim(2), 'live claims must not be taken over'
+        dead.complete(3)
+        time.sleep(0.3)
+        alive.renew()
+        time.sleep(0.3)
+        # the claim on 1 was renewed, the one on 2 expired, and 3 is finished
+        assert not other.claim(1), 'a renewed claim was taken over'
+        assert other.claim(2) == TAKEN_OVER, 'an expired claim was not taken over'
+        assert other.created(2) == [('Project', 2, 'group', 42)] and other.created(1) == []
+        assert not dead.claim(2) and not other.claim(3)
+        dead.complete(2, 'two', 'lost')
+        other.complete(2, 'two')
+        assert other.unfinished([1, 2, 3]) == [1]
+        assert other.failures() == [] and other.done_count() == 2
+
+def cost_plan():
+    costs = [10, 7, 5, 4, 3, 1, 0, 0]
+    return Plan([PlanEntry(i, 'p{}'.format(i), 1, cost, None) for (i, cost) in enumerate(costs)], 'size')
+
+def check_plan():
+    plan = cost_plan()
+    assert plan.project_ids('largest-first') == [0, 1, 2, 3, 4, 5, 6, 7]
+    assert plan.project_ids('smallest-first') == [6, 7, 5, 4, 3, 2, 1, 0]
+    assert plan.project_ids('id') == list(range(8))
+    rates = dict(bytes_per_second=1, seconds_per_repository=0)
+    assert plan.expected_seconds(1, **rates) == 30
+    assert plan.expected_seconds(2, **rates) == 15
+    # a small project left for last no longer waits behind the largest one
+    assert plan.expected_seconds(3, 'largest-first', **rates) < plan.expected_seconds(3, 'smallest-first', **rates)
+    with temporary_directory() as directory:
+        plan.save(path.join(directory, 'plan.json'))
+        loaded = Plan.load(path.join(directory, 'plan.json'))
+    assert loaded.entries == plan.entries and loaded.measure == plan.measure
+
+def check_shards():
+    plan = cost_plan()
+    costs = [e.cost for e in plan.entries]
+    shards = plan.shards(2)
+    assert sorted(pid for shard in shards for pid in shard) == list(range(len(costs))), shards
+    # greedy largest-first; a project without cost still counts as one
+    assert shards == [[0, 3, 5, 6], [1, 2, 4, 7]], shards
+    assert plan.shards(1) == [plan.project_ids()]
+    assert [len(s) for s in plan.shards(10)] == [1] * 8 + [0, 0]
+    # the hash shards must come out the same on every host and Python process
+    assert [shard_of(pid, 4) for pid in range(8)] == [0, 3, 0, 3, 2, 0, 0, 2]
+    assert all(0 <= shard_of(pid, 3) < 3 for pid in range(100))
+
+@contextmanager
+def workspace_directory():
+    # the importer runs with a relative workspace root, and alternates are resolved against the working directory
+    cwd = os.getcwd()
+    with temporary_directory() as directory:
+        os.chdir(directory)
+        try:
+            yield directory
+        finally:
+            os.chdir(cwd)
+
+def fake_mirror(local_path, size=1000, reference=None):
+    # just enough of a bare repository for the workspace: some bytes and, for forks, an alternates file
+    os.makedirs(path.join(local_path, 'objects', 'info'))
+    with open(path.join(local_path, 'objects', 'pack.bin'), 'wb') as f:
+        f.write(b'\0' * size)
+    if reference is not None:
+        with open(path.join(local_path, 'objects', 'info', 'alternates'), 'w') as f:
+            f.write(path.abspath(path.join(reference, 'objects')) + '\n')
+
+def mirrors(workspace):
+    return sorted(p for p in workspace._sizes if path.exists(p))
+
+def check_workspace_lru():
+    with workspace_directory():
+        workspace = Workspace('ws', budget=2500)
+        for name in ('a', 'b', 'a', 'c'):
+            with workspace.use('ws/g/' + name) as local_path:
+                if not path.exists(local_path):
+                    fake_mirror(local_path)
+        # b is the least recently used once c is released
+        assert mirrors(workspace) == ['ws/g/a', 'ws/g/c'], mirrors(workspace)
+        assert workspace.instrumentation.counters['evicted_mirrors'] == 1
+        # an earlier run's mirrors are picked up again
+        assert mirrors(Workspace('ws', budget=2500)) == ['ws/g/a', 'ws/g/c']
+
+def check_workspace_pins():
+    with workspace_directory():
+        for name in ('a', 'b'):
+            fake_mirror('ws/g/' + name)
+        workspace = Workspace('ws', budget=2500)
+        with workspace.use('ws/g/a'):
+            with workspace.use('ws/g/c'):
+                fake_mirror('ws/g/c')
+            # a is pinned, so b goes even though a is older
+            assert mirrors(workspace) == ['ws/g/a', 'ws/g/c'], mirrors(workspace)
+            workspace.discard('ws/g/a')
+            assert path.exists('ws/g/a'), 'a mirror in use was discarded'
+        assert mirrors(workspace) == ['ws/g/c'], mirrors(workspace)
+
+def check_workspace_forks():
+    with workspace_directory():
+        fake_mirror('ws/g/parent')
+        fake_mirror('ws/g/fork', reference='ws/g/parent')
+        fake_mirror('ws/g/other')
+        workspace = Workspace('ws')
+        assert workspace.alternate('ws/g/fork') == 'ws/g/parent'
+        # a fork in use keeps the mirror it borrows objects from, even when it was not named as reference
+        with workspace.use('ws/g/fork'):
+            workspace.discard('ws/g/parent')
+            assert path.exists('ws/g/parent'), 'the reference of a fork in use was removed'
+        # once released, the discarded parent goes and takes its fork along
+        assert mirrors(workspace) == ['ws/g/other'], mirrors(workspace)
+
+        fake_mirror('ws/g/parent', 3000)
+        fake_mirror('ws/g/fork', reference='ws/g/parent')
+        workspace = Workspace('ws', budget=3500)
+        with workspace.use('ws/g/fork', workspace.alternate('ws/g/fork')):
+            # parent and fork are in use, so only other could make room
+            assert mirrors(workspace) == ['ws/g/fork', 'ws/g/parent'], mirrors(workspace)
+        # idle again and still over budget: the parent goes, and its fork with it
+        assert mirrors(workspace) == [], mirrors(workspace)
+
+def check_workspace_wait():
+    with workspace_directory():
+        fake_mirror('ws/g/a', 1500)
+        workspace = Workspace('ws', budget=1000)
+        events = []
+        pinned = threading.Event()
+        def hold():
+            with workspace.use('ws/g/a'):
+                pinned.set()
+                time.sleep(0.3)
+                events.append('released a')
+        def wait():
+            pinned.wait()
+            with workspace.use('ws/g/b'):
+                events.append('using b, a exists: {}'.format(path.exists('ws/g/a')))
+        threads = [threading.Thread(target=hold), threading.Thread(target=wait)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        # b waited until a was released and evicted
+        assert events == ['released a', 'using b, a exists: False'], events
+        assert workspace.instrumentation.timings['workspace_wait'] > 0.1
+
+def repository(repo_id, project_id, name, hashed_path, parent=None):
+    # transient ORM objects are enough for RepositoryGraph and RepositoryGroup
+    return gitorious.Repository(id=repo_id, project_id=project_id, name=name, hashed_path=hashed_path,
+                                parent_id=None if parent is None else parent.id, parent=parent)
+
+def check_fork_trees():
+    project = gitorious.Project(id=1, slug='p')
+    mainline = repository(1, 1, 'mainline', 'aaa/bbb/ccc')
+    fork1 = repository(2, 1, 'fork1', 'f/1', mainline)
+    fork2 = repository(3, 1, 'fork2', 'f/2', mainline)
+    fork11 = repository(4, 1, 'fork11', 'f/11', fork1)
+    fork111 = repository(5, 1, 'fork111', 'f/111', fork11)
+    elsewhere = repository(6, 2, 'elsewhere', 'e/1', fork2)
+    graph = RepositoryGraph([fork111, elsewhere, fork11, fork2, fork1, mainline])
+    # breadth first, forks of forks included, forks living in other projects left out
+    assert graph.fork_tree(mainline) == [fork1, fork2, fork11, fork111], graph.fork_tree(mainline)
+    groups = list(RepositoryGroup.from_project(project, graph))
+    assert groups == [(mainline, None, [fork1, fork2, fork11, fork111])], groups
+    # without a graph, from_project builds one from the project's own repositories
+    project.repositories = [mainline, fork1, fork2, fork11, fork111]
+    assert list(RepositoryGroup.from_project(project)) == groups
+
+def check_wiki_mapping():
+    project = gitorious.Project(id=1, slug='p')
+    first = repository(1, 1, 'first', 'aaa/aaa/aaa')
+    second = repository(2, 1, 'second', 'bbb/bbb/bbb')
+    wiki = repository(3, 1, 'p-gitorious-wiki', 'bbb/bbb/bbb-gitorious-wiki')
+    groups = list(RepositoryGroup.from_project(project, RepositoryGraph([first, second, wiki])))
+    # a wiki whose hashed_path matches a repository goes with that repository
+    assert groups == [(first, None, []), (second, wiki, [])], groups
+    # otherwise wikis are handed out in order
+    unmatched = repository(3, 1, 'p-gitorious-wiki', 'zzz/zzz/zzz-gitorious-wiki')
+    groups = list(RepositoryGroup.from_project(project, RepositoryGraph([first, second, unmatched])))
+    assert groups == [(first, unmatched, []), (second, None, [])], groups
+    # a project left with only its wiki still migrates it
+    groups = list(RepositoryGroup.from_project(project, RepositoryGraph([unmatched])))
+    assert groups == [(unmatched, None, [])], groups
+
+def check_forks_without_mainline():
+    project = gitorious.Project(id=1, slug='p')
+    mainline = repository(1, 2, 'mainline', 'aaa/bbb/ccc')
+    fork = repository(2, 1, 'fork', 'f/1', mainline)
+    try:
+        list(RepositoryGroup.from_project(project, RepositoryGraph([mainline, fork])))
+    except UnmigratedRepositoryError as ex:
+        assert 'forks' in str(ex), ex
+    else:
+        raise AssertionError('forks without mainline were not reported')
+
+CHECKS = [check_parse_rows, check_dump_values, check_taggings_filter, check_claim_takeover, check_plan, check_shards,
+          check_workspace_lru, check_workspace_pins, check_workspace_forks, check_workspace_wait,
+          check_fork_trees, check_wiki_mapping, check_forks_without_mainline]
+
+def main():
+    failed = 0
+    for check in CHECKS:
+        try:
+            check()
+            print('ok      {}'.format(check.__name__))
+        except Exception:
+            failed += 1
+            print('FAILED  {}'.format(check.__name__))
+            traceback.print_exc()
+    sys.exit(failed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,353 @@
+import argparse
+import itertools
+import json
+import os
+import os.path as path
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+OWNER_ACCESS = 50
+
+class NotFound(Exception):
+    pass
+
+class Conflict(Exception):
+    pass
+
+
+class FakeGitlab(object):
+    # In-memory stand-in for the subset of the GitLab v4 API that ImportSession uses. Repositories are
+    # real bare repositories served by git http-backend, so clones and pushes transfer real packs.
+    # With a deletion_delay, deleted objects stay visible for that many seconds, like GitLab's background jobs.
+    def __init__(self, repository_root, base_url='', deletion_delay=0, latency=0):
+        self.repository_root = repository_root
+        # seconds added to every API response, standing in for the round trip to a remote GitLab
+        self.latency = latency
+        self.base_url = base_url
+        self.deletion_delay = deletion_delay
+        self.pending = dict()
+        self.lock = threading.Lock()
+        self.ids = itertools.count(2)
+        self.users = {1: {'id': 1, 'username': 'root', 'name': 'Administrator', 'email': 'admin@example.com'}}
+        self.keys = dict()
+        self.groups = dict()
+        self.projects = dict()
+        self.members = dict()
+        self.stats = Counter()
+        self.routes = [
+            ('GET', r'/users', self.list_users),
+            ('POST', r'/users', self.create_user),
+            ('GET', r'/users/(\d+)', self.get_user),
+            ('DELETE', r'/users/(\d+)', self.delete_user),
+            ('GET', r'/users/(\d+)/keys', self.list_keys),
+            ('POST', r'/users/(\d+)/keys', self.create_key),
+            ('POST', r'/users/(\d+)/impersonation_tokens', self.create_token),
+            ('POST', r'/projects/user/(\d+)', self.create_user_project),
+            ('GET', r'/groups', self.list_groups),
+            ('POST', r'/groups', self.create_group),
+            ('GET', r'/groups/(\d+)', self.get_group),
+            ('DELETE', r'/groups/(\d+)', self.delete_group),
+            ('GET', r'/groups/(\d+)/members', self.list_members),
+            ('POST', r'/groups/(\d+)/members', self.add_member),
+            ('GET', r'/projects', self.list_projects),
+            ('POST', r'/projects', self.create_project),
+            ('GET', r'/projects/(\d+)', self.get_project),
+            ('DELETE', r'/projects/(\d+)', self.delete_project),
+            ('GET', r'/projects/(\d+)/members', self.list_members),
+            ('POST', r'/projects/(\d+)/members', self.add_member),
+            ('POST', r'/projects/(\d+)/fork/(\d+)', self.create_fork_relation),
+        ]
+
+    def dispatch(self, verb, route, query, body):
+        for (route_verb, pattern, handler) in self.routes:
+            match = re.fullmatch(pattern, route)
+            if route_verb == verb and match is not None:
+                self.stats['api_calls'] += 1
+                self.stats['{} {}'.format(verb, pattern)] += 1
+                with self.lock:
+                    self._collect()
+                    return handler(query, body, *(int(g) for g in match.groups()))
+        raise NotFound(route)
+
+    def list_users(self, query, body):
+        users = list(self.users.values())
+        if 'username' in query:
+            users = [u for u in users if u['username'] == query['username']]
+        return users
+
+    def create_user(self, query, body):
+        if any(u['username'] == body['username'] for u in self.users.values()):
+            raise Conflict('Username has already been taken')
+        user_id = next(self.ids)
+        self.users[user_id] = dict(id=user_id, username=body['username'], name=body.get('name'), email=body.get('email'))
+        return self.users[user_id]
+
+    def get_user(self, query, body, user_id):
+        return self._find(self.users, user_id)
+
+    def delete_user(self, query, body, user_id):
+        self._find(self.users, user_id)
+        self._schedule(('users', user_id), lambda: self.users.pop(user_id))
+
+    def list_keys(self, query, body, user_id):
+        return [k for k in self.keys.values() if k['user_id'] == user_id]
+
+    def create_key(self, query, body, user_id):
+        key_id = next(self.ids)
+        self.keys[key_id] = dict(id=key_id, user_id=user_id, title=body['title'], key=body['key'])
+        return self.keys[key_id]
+
+    def create_token(self, query, body, user_id):
+        return dict(id=next(self.ids), user_id=user_id, token='token-{}'.format(user_id), name=body['name'])
+
+    def list_groups(self, query, body):
+        return [g for g in self.groups.values() if query.get('search', '') in g['path']]
+
+    def create_group(self, query, body):
+        if any(g['path'] == body['path'] for g in self.groups.values()):
+            raise Conflict('Path has already been taken')
+        group_id = next(self.ids)
+        self.groups[group_id] = dict(id=group_id, name=body['name'], path=body['path'], description=body.get('description'))
+        self.members[('groups', group_id)] = dict()
+        return self.groups[group_id]
+
+    def get_group(self, query, body, group_id):
+        return self._find(self.groups, group_id)
+
+    def delete_group(self, query, body, group_id):
+        self._find(self.groups, group_id)
+        self._schedule(('groups', group_id), lambda: self._remove_group(group_id))
+        return {'message': '202 Accepted'}
+
+    def list_members(self, query, body, owner_id):
+        members = self._members(owner_id).values()
+        if 'access_level' in query:
+            members = [m for m in members if m['access_level'] >= int(query['access_level'])]
+        return list(members)
+
+    def add_member(self, query, body, owner_id):
+        members = self._members(owner_id)
+        if type(body['user_id']) is str and ',' in body['user_id']:
+            for user_id in (int(u) for u in body['user_id'].split(',')):
+                members.setdefault(user_id, dict(id=user_id, access_level=body['access_level']))
+            return {'status': 'success'}
+        if body['user_id'] in members:
+            raise Conflict('Member already exists')
+        members[body['user_id']] = dict(id=body['user_id'], access_level=body['access_level'])
+        return members[body['user_id']]
+
+    def list_projects(self, query, body):
+        return [p for p in self.projects.values() if query.get('search', '') in p['name']]
+
+    def create_project(self, query, body):
+        group = self._find(self.groups, body['namespace_id'])
+        return self._create_project(body, dict(id=group['id'], path=group['path'], kind='group', full_path=group['path']), None)
+
+    def create_user_project(self, query, body, user_id):
+        user = self._find(self.users, user_id)
+        namespace = dict(id=user_id, path=user['username'], kind='user', full_path=user['username'])
+        return self._create_project(body, namespace, dict(id=user_id))
+
+    def get_project(self, query, body, project_id):
+        return self._find(self.projects, project_id)
+
+    def delete_project(self, query, body, project_id):
+        self._find(self.projects, project_id)
+        self._schedule(('projects', project_id), lambda: self._remove_project(project_id))
+        return {'message': '202 Accepted'}
+
+    def create_fork_relation(self, query, body, project_id, forked_from_id):
+        project = self._find(self.projects, project_id)
+        project['forked_from_project'] = dict(id=self._find(self.projects, forked_from_id)['id'])
+        return project
+
+    def _create_project(self, body, namespace, owner):
+        project_path = body.get('path', body['name'])
+        if any(p['namespace']['id'] == namespace['id'] and p['path'] == project_path for p in self.projects.values()):
+            raise Conflict('Path has already been taken')
+        project_id = next(self.ids)
+        full_path = '{}/{}'.format(namespace['path'], project_path)
+        project = dict(id=project_id, name=body['name'], path=project_path, description=body.get('description'),
+                       namespace=namespace, path_with_namespace=full_path, tag_list=body.get('tag_list', []),
+                       http_url_to_repo='{}/{}.git'.format(self.base_url, full_path))
+        if owner is not None:
+            project['owner'] = owner
+        self.projects[project_id] = project
+        self.members[('projects', project_id)] = dict()
+        if namespace['kind'] == 'user':
+            self.members[('projects', project_id)][owner['id']] = dict(id=owner['id'], access_level=OWNER_ACCESS)
+        for suffix in ('.git', '.wiki.git'):
+            repo_path = path.join(self.repository_root, full_path + suffix)
+            if not path.exists(repo_path):
+                subprocess.check_call(['git', 'init', '-q', '--bare', repo_path])
+        return project
+
+    def _schedule(self, key, remove):
+        if self.deletion_delay <= 0:
+            remove()
+        elif key not in self.pending:
+            self.pending[key] = (time.monotonic() + self.deletion_delay, remove)
+
+    def _collect(self):
+        now = time.monotonic()
+        for (key, (deadline, remove)) in list(self.pending.items()):
+            if deadline <= now:
+                del self.pending[key]
+                remove()
+
+    def _remove_group(self, group_id):
+        for project in [p for p in self.projects.values() if p['namespace']['id'] == group_id]:
+            self._remove_project(project['id'])
+        del self.groups[group_id]
+
+    def _remove_project(self, project_id):
+        project = self.projects.pop(project_id, None)
+        if project is None:
+            return
+        for suffix in ('.git', '.wiki.git'):
+            shutil.rmtree(path.join(self.repository_root, project['path_with_namespace'] + suffix), ignore_errors=True)
+
+    def _members(self, owner_id):
+        for kind in ('groups', 'projects'):
+            if (kind, owner_id) in self.members:
+                return self.members[(kind, owner_id)]
+        raise NotFound(owner_id)
+
+    def _find(self, objects, obj_id):
+        if obj_id not in objects:
+            raise NotFound(obj_id)
+        return objects[obj_id]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+    @property
+    def gitlab(self):
+        return self.server.gitlab
+
+    def handle_request(self, verb):
+        url = urlparse(self.path)
+        body = self.read_body()
+        if url.path == '/_stats':
+            return self.respond(200, {'Content-Type': 'application/json'}, json.dumps(self.gitlab.stats).encode())
+
+        self.gitlab.stats['bytes_in'] += len(body) + len(self.requestline) + len(str(self.headers))
+        if url.path.startswith('/api/v4/'):
+            self.handle_api(verb, url, body)
+        else:
+            self.handle_git(verb, url, body)
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def handle_api(self, verb, url, body):
+        query = dict((k, v[-1]) for (k, v) in parse_qs(url.query).items())
+        time.sleep(self.gitlab.latency)
+        try:
+            data = json.loads(body.decode()) if len(body) > 0 else dict()
+            result = self.gitlab.dispatch(verb, url.path[len('/api/v4'):], query, data)
+        except NotFound as ex:
+            return self.respond_json(404, {'message': '404 {} Not Found'.format(ex)})
+        except Conflict as ex:
+            return self.respond_json(409, {'message': str(ex)})
+
+        headers = dict()
+        if isinstance(result, list):
+            page, per_page = int(query.get('page', 1)), int(query.get('per_page', 20))
+            headers.update({'X-Page': str(page), 'X-Per-Page': str(per_page), 'X-Total': str(len(result))})
+            if page * per_page < len(result):
+                next_query = dict(query, page=page + 1, per_page=per_page)
+                headers['Link'] = '<http://{}{}?{}>; rel="next"'.format(self.headers['Host'], url.path, urlencode(next_query))
+            result = result[(page - 1) * per_page:page * per_page]
+        self.respond_json(201 if verb == 'POST' else 200, result, headers)
+
+    def handle_git(self, verb, url, body):
+        self.gitlab.stats['git_requests'] += 1
+        env = dict(os.environ, GIT_PROJECT_ROOT=self.gitlab.repository_root, GIT_HTTP_EXPORT_ALL='1',
+                   PATH_INFO=url.path, QUERY_STRING=url.query, REQUEST_METHOD=verb, REMOTE_USER='import',
+                   REMOTE_ADDR=self.client_address[0], CONTENT_TYPE=self.headers.get('Content-Type', ''),
+                   CONTENT_LENGTH=str(len(body)), HTTP_CONTENT_ENCODING=self.headers.get('Content-Encoding', ''),
+                   GIT_PROTOCOL=self.headers.get('Git-Protocol', ''))
+        output = subprocess.run(['git', 'http-backend'], input=body, env=env, stdout=subprocess.PIPE).stdout
+        (raw_headers, _, content) = output.partition(b'\r\n\r\n')
+        status, headers = 200, dict()
+        for line in raw_headers.decode().split('\r\n'):
+            (name, _, value) = line.partition(':')
+            if name.lower() == 'status':
+                status = int(value.strip().split(' ')[0])
+            elif name:
+                headers[name] = value.strip()
+        self.respond(status, headers, content)
+
+    def respond_json(self, status, data, headers=None):
+        headers = dict(headers or dict(), **{'Content-Type': 'application/json'})
+        self.respond(status, headers, b'' if data is None else json.dumps(data).encode())
+
+    def respond(self, status, headers, content):
+        self.send_response(status)
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+        if self.path != '/_stats':
+            self.gitlab.stats['bytes_out'] += len(content)
+
+
+def serve(port=0, repository_root=None, deletion_delay=0, latency=0):
+    repository_root = repository_root or tempfile.mkdtemp(prefix='fake-gitlab-')
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.gitlab = FakeGitlab(repository_root, 'http://127.0.0.1:{}'.format(server.server_address[1]), deletion_delay, latency)
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a local stand-in for the GitLab v4 API')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--repository-root')
+    parser.add_argument('--deletion-delay', type=float, default=0, help='seconds before deleted objects disappear')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every API response')
+    args = parser.parse_args()
+    server = serve(args.port, args.repository_root, args.deletion_delay, args.latency)
+    print(server.server_address[1])
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
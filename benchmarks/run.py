@@ -0,0 +1,209 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import os.path as path
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+from benchmarks import synthetic
+from gitorious2gitlab.importer import ImportSession
+from gitorious2gitlab.instrumentation import Instrumentation, JsonLinesInstrumentation
+from gitorious2gitlab.planner import build_plan
+
+def max_child_rss_mb():
+    # the largest child process (git) so far; ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024.0 ** 2
+    except OSError:
+        # without /proc, the highest value since the process started is all there is
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+@contextlib.contextmanager
+def sampled_peak_rss(interval=0.05):
+    # ru_maxrss never goes down, so the peak of a single phase is sampled while it runs
+    peak = [rss_mb()]
+    stopped = threading.Event()
+    def sample():
+        while not stopped.wait(interval):
+            peak[0] = max(peak[0], rss_mb())
+    thread = threading.Thread(target=sample, daemon=True)
+    thread.start()
+    try:
+        yield peak
+    finally:
+        stopped.set()
+        thread.join()
+        peak[0] = max(peak[0], rss_mb())
+
+
+def server_stats(gitlab_url):
+    with urllib.request.urlopen(gitlab_url + '/_stats') as response:
+        return json.loads(response.read().decode())
+
+
+def start_fake_gitlab(workdir, deletion_delay=0, latency=0):
+    shutil.rmtree(path.join(workdir, 'gitlab'), ignore_errors=True)
+    server = subprocess.Popen([sys.executable, '-m', 'benchmarks.fake_gitlab', '--repository-root', path.join(workdir, 'gitlab'),
+                               '--deletion-delay', str(deletion_delay), '--latency', str(latency)],
+                              stdout=subprocess.PIPE, cwd=path.dirname(path.dirname(path.abspath(__file__))))
+    port = int(server.stdout.readline())
+    return (server, 'http://127.0.0.1:{}'.format(port))
+
+
+def start_git_daemon(daemon_root):
+    # port 0 is not supported by git daemon, so pick a free one up front
+    with contextlib.closing(socket.socket()) as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    daemon = subprocess.Popen(['git', 'daemon', '--export-all', '--reuseaddr', '--listen=127.0.0.1', '--port={}'.format(port),
+                               '--base-path=' + daemon_root, daemon_root])
+    time.sleep(0.5)
+    return (daemon, '127.0.0.1:{}'.format(port))
+
+
+def measure(name, gitlab_url, session, action, quiet):
+    before = server_stats(gitlab_url)
+    client_calls = session.gl.call_count
+    start = time.monotonic()
+    output = io.StringIO()
+    with sampled_peak_rss() as peak_rss, contextlib.redirect_stdout(output) if quiet else contextlib.ExitStack():
+        result = action()
+    elapsed = time.monotonic() - start
+    after = server_stats(gitlab_url)
+    return {
+        'phase': name,
+        'seconds': round(elapsed, 3),
+        'api_calls': after.get('api_calls', 0) - before.get('api_calls', 0),
+        'client_api_calls': session.gl.call_count - client_calls,
+        'git_requests': after.get('git_requests', 0) - before.get('git_requests', 0),
+        'bytes_in': after.get('bytes_in', 0) - before.get('bytes_in', 0),
+        'bytes_out': after.get('bytes_out', 0) - before.get('bytes_out', 0),
+        'peak_rss_mb': round(peak_rss[0], 1),
+        'max_child_rss_mb': round(max_child_rss_mb(), 1),
+        'result': repr(result)[0:200]
+    }
+
+
+def run(args):
+    if args.metrics:
+        args.metrics = path.abspath(args.metrics)
+    if args.profile_dir:
+        args.profile_dir = path.abspath(args.profile_dir)
+    workdir = path.abspath(args.workdir or tempfile.mkdtemp(prefix='g2g-bench-'))
+    if not path.exists(workdir):
+        os.makedirs(workdir)
+    db_path = path.join(workdir, 'gitorious.sqlite')
+    repository_root = path.join(workdir, 'gitorious')
+    if not path.exists(db_path) or args.regenerate:
+        shutil.rmtree(repository_root, ignore_errors=True)
+        synthetic.generate(db_path, repository_root, args.users, args.groups, args.projects, args.forks, args.wikis,
+                           args.tags, args.commits, args.file_size, args.seed, args.nested_forks)
+
+    processes = []
+    try:
+        (server, gitlab_url) = start_fake_gitlab(workdir, args.deletion_delay, args.api_latency)
+        processes.append(server)
+        if args.source == 'daemon':
+            daemon_root = path.join(workdir, 'daemon')
+            synthetic.link_daemon_tree(db_path, repository_root, daemon_root)
+            (daemon, gitorious_url) = start_git_daemon(daemon_root)
+            processes.append(daemon)
+            source_root = None
+        else:
+            (gitorious_url, source_root) = ('unused', path.abspath(repository_root))
+
+        exports = path.join(workdir, 'importer')
+        shutil.rmtree(exports, ignore_errors=True)
+        os.makedirs(exports)
+        os.chdir(exports)
+        instrumentation = JsonLinesInstrumentation(args.metrics) if args.metrics else Instrumentation()
+        session = ImportSession(path.abspath(db_path), gitorious_url, gitlab_url, 'benchmark-token',
+                                workers=args.workers, repository_root=source_root, instrumentation=instrumentation,
+                                workspace_budget=args.workspace_budget, workspace_policy=args.workspace_policy,
+                                repack=args.repack, pipeline=not args.no_pipeline, member_batch_size=args.member_batch_size,
+                                profile_dir=args.profile_dir, profile_threshold=args.profile_threshold)
+
+        plan = build_plan(session.gitorious, path.abspath(repository_root)) if args.policy else None
+        report = [measure('create_users', gitlab_url, session, session.create_users, args.quiet),
+                  measure('migrate_projects', gitlab_url, session,
+                          lambda: session.migrate_projects(plan=plan, policy=args.policy, chunk_size=args.chunk_size),
+                          args.quiet)]
+        if args.sync:
+            report.append(measure('sync', gitlab_url, session, lambda: session.sync(chunk_size=args.chunk_size), args.quiet))
+        report.append(measure('cleanup', gitlab_url, session, session.cleanup, args.quiet))
+        if args.reset_cycle:
+            # the names freed by cleanup must be usable again straight away
+            report.append(measure('remigrate_projects', gitlab_url, session,
+                                  lambda: session.migrate_projects(chunk_size=args.chunk_size), args.quiet))
+            report.append(measure('cleanup', gitlab_url, session, session.cleanup, args.quiet))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the migration phases against synthetic data and a fake GitLab')
+    parser.add_argument('--workdir')
+    parser.add_argument('--regenerate', action='store_true')
+    parser.add_argument('--source', choices=('local', 'daemon'), default='local')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--groups', type=int, default=5)
+    parser.add_argument('--projects', type=int, default=20)
+    parser.add_argument('--forks', type=int, default=2)
+    parser.add_argument('--wikis', type=float, default=0.3)
+    parser.add_argument('--tags', type=int, default=3)
+    parser.add_argument('--commits', type=int, default=10)
+    parser.add_argument('--file-size', type=int, default=4096)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--nested-forks', type=float, default=0.0, help='share of forks that clone another fork')
+    parser.add_argument('--chunk-size', type=int, help='stream projects in chunks of this many ids')
+    parser.add_argument('--workspace-budget', type=int, help='disk budget for local mirrors, in bytes')
+    parser.add_argument('--workspace-policy', choices=('lru', 'after-push'), default='lru')
+    parser.add_argument('--reset-cycle', action='store_true', help='migrate again after cleanup, then clean up once more')
+    parser.add_argument('--repack', action='store_true', help='repack mirrors before pushing them')
+    parser.add_argument('--no-pipeline', action='store_true', help='create each repo group\'s GitLab projects right before pushing it')
+    parser.add_argument('--member-batch-size', type=int, default=1, help='users added per membership request')
+    parser.add_argument('--sync', action='store_true', help='measure an incremental sync before cleanup')
+    parser.add_argument('--policy', choices=('largest-first', 'smallest-first', 'id'),
+                        help='plan the migration first and hand projects to the workers in this order')
+    parser.add_argument('--deletion-delay', type=float, default=0,
+                        help='seconds the fake GitLab keeps deleted objects around, like its background jobs')
+    parser.add_argument('--api-latency', type=float, default=0, help='seconds the fake GitLab waits before every API response')
+    parser.add_argument('--metrics', help='write per-project instrumentation records to this JSON lines file')
+    parser.add_argument('--profile-dir', help='save profiles of projects slower than --profile-threshold here')
+    parser.add_argument('--profile-threshold', type=float, default=300)
+    parser.add_argument('--quiet', action='store_true', help='suppress the importer\'s progress output')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON lines')
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.json:
+        for phase in report:
+            print(json.dumps(phase))
+        return
+    columns = ('phase', 'seconds', 'api_calls', 'git_requests', 'bytes_in', 'bytes_out', 'peak_rss_mb', 'max_child_rss_mb')
+    print(' '.join('{:>17}'.format(c) for c in columns))
+    for phase in report:
+        print(' '.join('{:>17}'.format(phase[c]) for c in columns))
+
+
+if __name__ == '__main__':
+    main()
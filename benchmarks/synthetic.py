@@ -0,0 +1,169 @@
+import argparse
+import hashlib
+import os
+import os.path as path
+import random
+import subprocess
+
+from datetime import datetime
+
+from sqlalchemy import create_engine
+
+import gitorious2gitlab.gitorious as gitorious
+
+GIT_ENV = dict(os.environ, GIT_AUTHOR_NAME='bench', GIT_AUTHOR_EMAIL='bench@example.com',
+               GIT_COMMITTER_NAME='bench', GIT_COMMITTER_EMAIL='bench@example.com')
+
+
+def hashed_path(seed):
+    digest = hashlib.sha1(seed.encode()).hexdigest()
+    return '{}/{}/{}'.format(digest[0:3], digest[3:6], digest[6:])
+
+
+def fast_import_stream(rng, commits, file_size, prefix, parent=None):
+    # a linear history on master where every commit rewrites one of a handful of files
+    timestamp = 1300000000
+    for i in range(commits):
+        data = rng.getrandbits(8 * file_size).to_bytes(file_size, 'little')
+        message = '{} commit {}'.format(prefix, i).encode()
+        yield b'blob\nmark :1\ndata ' + str(len(data)).encode() + b'\n' + data + b'\n'
+        yield b'commit refs/heads/master\n'
+        yield 'committer bench <bench@example.com> {} +0000\n'.format(timestamp + i).encode()
+        yield b'data ' + str(len(message)).encode() + b'\n' + message + b'\n'
+        if i == 0 and parent is not None:
+            yield 'from {}\n'.format(parent).encode()
+        yield 'M 644 :1 {}/file{}.bin\n\n'.format(prefix, i % 5).encode()
+    yield b'reset refs/tags/v1\nfrom refs/heads/master\n\n'
+
+
+def write_repo(repo_path, rng, commits, file_size, prefix, parent_path=None):
+    if parent_path is None:
+        subprocess.check_call(['git', 'init', '-q', '--bare', repo_path], env=GIT_ENV)
+        parent = None
+    else:
+        subprocess.check_call(['git', 'clone', '-q', '--bare', parent_path, repo_path], env=GIT_ENV)
+        parent = 'refs/heads/master^0'
+    importer = subprocess.Popen(['git', '--git-dir', repo_path, 'fast-import', '--quiet', '--force'],
+                                stdin=subprocess.PIPE, env=GIT_ENV)
+    for chunk in fast_import_stream(rng, commits, file_size, prefix, parent):
+        importer.stdin.write(chunk)
+    importer.stdin.close()
+    if importer.wait() != 0:
+        raise RuntimeError('fast-import failed for ' + repo_path)
+
+
+def generate(db_path, repository_root, users=50, groups=5, projects=20, forks=2, wikis=0.3, tags=3,
+             commits=10, file_size=4096, seed=0, nested_forks=0.0):
+    rng = random.Random(seed)
+    if path.exists(db_path):
+        os.remove(db_path)
+    gitorious.Base.metadata.create_all(create_engine('sqlite:///' + db_path))
+    session = gitorious.setup_session(db_path)
+    now = datetime(2013, 1, 1)
+
+    session.add(gitorious.Site(id=1, title='Gitorious', created_at=now, updated_at=now))
+    all_users = [gitorious.User(id=i, login='user{}'.format(i), email='user{}@example.com'.format(i),
+                                fullname='User {}'.format(i), created_at=now, updated_at=now)
+                 for i in range(1, users + 1)]
+    session.add_all(all_users)
+    session.add_all(gitorious.SshKey(id=u.id, user_id=u.id, key='ssh-rsa AAAAB3Nza{} user{}'.format(u.id, u.id),
+                                     created_at=now, updated_at=now) for u in all_users)
+
+    all_groups = []
+    for i in range(1, groups + 1):
+        members = rng.sample(all_users, min(len(all_users), rng.randint(2, 5)))
+        group = gitorious.Group(id=i, name='group{}'.format(i), admin=members[0], members=members,
+                                created_at=now, updated_at=now)
+        all_groups.append(group)
+    session.add_all(all_groups)
+
+    all_tags = [gitorious.Tag(id=i, name='tag{}'.format(i)) for i in range(1, tags * 3 + 1)]
+    session.add_all(all_tags)
+    session.flush()
+
+    repository_id = 0
+    for i in range(1, projects + 1):
+        if len(all_groups) > 0 and i % 2 == 0:
+            owner = rng.choice(all_groups)
+            owner_type, owner_user = 'Group', owner.admin
+        else:
+            owner = rng.choice(all_users)
+            owner_type, owner_user = 'User', owner
+        project = gitorious.Project(id=i, slug='project{}'.format(i), title='Project {}'.format(i),
+                                    description='synthetic project {}'.format(i), owner_id=owner.id,
+                                    owner_type=owner_type, user_id=owner_user.id, site_id=1, wiki_enabled=1,
+                                    created_at=now, updated_at=now, tags=rng.sample(all_tags, min(tags, len(all_tags))))
+        session.add(project)
+
+        repository_id += 1
+        main = gitorious.Repository(id=repository_id, name='project{}'.format(i), description='mainline',
+                                    hashed_path=hashed_path('repo{}'.format(repository_id)), project_id=i,
+                                    owner_id=owner.id, owner_type=owner_type, user_id=owner_user.id,
+                                    created_at=now, updated_at=now)
+        session.add(main)
+        main_path = main.local_path(repository_root)
+        write_repo(main_path, rng, commits, file_size, main.name)
+        for committer in rng.sample(all_users, min(3, len(all_users))):
+            session.add(gitorious.Committership(committer_id=committer.id, committer_type='User', repository_id=main.id))
+
+        if rng.random() < wikis:
+            repository_id += 1
+            wiki = gitorious.Repository(id=repository_id, name=main.name + '-gitorious-wiki',
+                                        hashed_path=main.hashed_path + '-gitorious-wiki', project_id=i,
+                                        owner_id=owner.id, owner_type=owner_type, user_id=owner_user.id,
+                                        created_at=now, updated_at=now)
+            session.add(wiki)
+            write_repo(wiki.local_path(repository_root), rng, 2, 256, 'wiki')
+
+        project_forks = [main]
+        for f in range(forks):
+            repository_id += 1
+            fork_owner = rng.choice(all_users)
+            # with probability nested_forks, clone one of the existing forks instead of the mainline
+            parent = rng.choice(project_forks[1:]) if len(project_forks) > 1 and rng.random() < nested_forks else main
+            fork = gitorious.Repository(id=repository_id, name='{}-clone{}'.format(main.name, f), parent_id=parent.id,
+                                        hashed_path=hashed_path('repo{}'.format(repository_id)), project_id=i,
+                                        owner_id=fork_owner.id, owner_type='User', user_id=fork_owner.id,
+                                        created_at=now, updated_at=now)
+            session.add(fork)
+            write_repo(fork.local_path(repository_root), rng, 2, file_size, fork.name,
+                       parent_path=parent.local_path(repository_root))
+            project_forks.append(fork)
+
+    session.commit()
+    session.close()
+
+
+def link_daemon_tree(db_path, repository_root, daemon_root):
+    # git daemon serves <slug>/<name>.git, which is what Repository.clone_url() points at
+    session = gitorious.setup_session(db_path)
+    for repo in session.query(gitorious.Repository):
+        link = path.join(daemon_root, repo.project.slug, repo.name + '.git')
+        if not path.exists(path.dirname(link)):
+            os.makedirs(path.dirname(link))
+        if not path.exists(link):
+            os.symlink(path.abspath(repo.local_path(repository_root)), link)
+    session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a synthetic Gitorious database and repositories')
+    parser.add_argument('db_path')
+    parser.add_argument('repository_root')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--groups', type=int, default=5)
+    parser.add_argument('--projects', type=int, default=20)
+    parser.add_argument('--forks', type=int, default=2)
+    parser.add_argument('--wikis', type=float, default=0.3)
+    parser.add_argument('--tags', type=int, default=3)
+    parser.add_argument('--commits', type=int, default=10)
+    parser.add_argument('--file-size', type=int, default=4096)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--nested-forks', type=float, default=0.0)
+    args = parser.parse_args()
+    generate(args.db_path, args.repository_root, args.users, args.groups, args.projects, args.forks, args.wikis,
+             args.tags, args.commits, args.file_size, args.seed, args.nested_forks)
+
+
+if __name__ == '__main__':
+    main()
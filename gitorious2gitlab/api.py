@@ -0,0 +1,131 @@
+import random
+import threading
+import time
+
+from collections import Counter
+from email.utils import parsedate_to_datetime
+
+import gitlab
+import requests
+
+from requests.adapters import HTTPAdapter
+
+from gitorious2gitlab.instrumentation import Instrumentation
+
+# requests that the server may not have processed and can safely be sent again
+RETRY_STATUSES = {
+    'get': (429, 500, 502, 503, 504),
+    'delete': (429, 502, 503, 504),
+    'post': (429,),
+    'put': (429,)
+}
+
+class GitlabClient(gitlab.Gitlab):
+    def __init__(self, url, private_token, pool_size=10, retries=5, backoff=0.5, instrumentation=None, timeout=60,
+                 **kwargs):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        # python-gitlab's errors do not carry the response headers, so each thread keeps its last response
+        session.hooks['response'].append(self._keep_response)
+        super().__init__(url, private_token=private_token, session=session, timeout=timeout, **kwargs)
+
+        self.retries = retries
+        self.backoff = backoff
+        self.instrumentation = instrumentation or Instrumentation()
+        self.calls = Counter()
+        self._calls_lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def call_count(self):
+        return sum(self.calls.values())
+
+    @property
+    def thread_call_count(self):
+        return getattr(self._local, 'calls', 0)
+
+    def http_request(self, verb, path, *args, **kwargs):
+        attempt = 0
+        while True:
+            self._count(verb)
+            self._local.response = None
+            try:
+                with self.instrumentation.timer('api'):
+                    return super().http_request(verb, path, *args, **kwargs)
+            except gitlab.GitlabHttpError as ex:
+                if attempt >= self.retries or ex.response_code not in RETRY_STATUSES.get(verb, ()):
+                    raise
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.retries or verb != 'get':
+                    raise
+            self.instrumentation.count('api_retries')
+            delay = self._retry_after()
+            if delay is None:
+                delay = self.backoff * (2 ** attempt) * (1 + random.random())
+            time.sleep(delay)
+            attempt += 1
+
+    def _keep_response(self, response, *args, **kwargs):
+        self._local.response = response
+
+    def _retry_after(self):
+        # seconds a rate limited (429) server asked us to wait, if it said so
+        response = getattr(self._local, 'response', None)
+        if response is None or response.status_code != 429:
+            return None
+        retry_after = response.headers.get('Retry-After', '').strip()
+        if retry_after.isdigit():
+            return float(retry_after)
+        if len(retry_after) > 0:
+            try:
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+        reset = response.headers.get('RateLimit-Reset', '').strip()
+        if reset.isdigit():
+            return max(0.0, int(reset) - time.time())
+        return None
+
+    def _count(self, verb):
+        with self._calls_lock:
+            self.calls[verb] += 1
+        self._local.calls = self.thread_call_count + 1
+        self.instrumentation.count('api_calls')
+
+
+class ObjectCache(object):
+    def __init__(self, ttl=600, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = dict()
+        self._lock = threading.Lock()
+
+    def get(self, kind, key, load):
+        with self._lock:
+            entry = self._entries.get((kind, key))
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        return self.put(kind, key, load())
+
+    def put(self, kind, key, value):
+        with self._lock:
+            self._entries[(kind, key)] = (time.monotonic() + self.ttl, value)
+            if len(self._entries) > self.max_entries:
+                self._prune()
+        return value
+
+    def _prune(self):
+        # drop expired entries first, then the ones closest to expiring, leaving room for new ones
+        now = time.monotonic()
+        for key in [k for (k, (expires, _)) in self._entries.items() if expires <= now]:
+            del self._entries[key]
+        if len(self._entries) > self.max_entries:
+            entries = sorted(self._entries.items(), key=lambda item: item[1][0])
+            for (key, _) in entries[0:len(entries) - self.max_entries // 2]:
+                del self._entries[key]
+
+    def invalidate(self, kind, key):
+        with self._lock:
+            self._entries.pop((kind, key), None)
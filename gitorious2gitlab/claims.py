@@ -0,0 +1,135 @@
+import hashlib
+import os
+import socket
+import threading
+import time
+
+from contextlib import contextmanager
+
+from sqlalchemy import and_, create_engine, func, select, Column, Float, Integer, MetaData, String, Table, Text
+from sqlalchemy.exc import IntegrityError
+
+CLAIMED = 'claimed'
+# claim() result for a project whose previous owner let its claim expire
+TAKEN_OVER = 'taken over'
+DONE = 'done'
+FAILED = 'failed'
+
+def shard_of(project_id, shard_count):
+    # stable across hosts and Python processes, unlike hash()
+    return int(hashlib.sha1(str(project_id).encode()).hexdigest(), 16) % shard_count
+
+def default_owner():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class ClaimStore(object):
+    # Coordinates several migration hosts through one table. A project belongs to whoever inserted its
+    # row, until the claim expires; live owners keep their claims fresh with heartbeat(). The ids of the
+    # GitLab objects created for a project are kept next to its claim, for whoever takes it over. Takes a
+    # SQLAlchemy URL (e.g. postgresql://...) or the path of a SQLite file on shared storage.
+    def __init__(self, url, owner=None, ttl=900):
+        if '://' not in url:
+            url = 'sqlite:///' + url
+        connect_args = {'timeout': 60, 'check_same_thread': False} if url.startswith('sqlite') else {}
+        self._engine = create_engine(url, connect_args=connect_args)
+        self.owner = owner or default_owner()
+        self.ttl = ttl
+        metadata = MetaData()
+        self._claims = Table('claims', metadata,
+                             Column('project_id', Integer, primary_key=True, autoincrement=False),
+                             Column('owner', String(255), nullable=False),
+                             Column('expires', Float, nullable=False),
+                             Column('status', String(16), nullable=False),
+                             Column('slug', String(255)),
+                             Column('error', Text))
+        self._created = Table('created', metadata,
+                              Column('project_id', Integer, primary_key=True, autoincrement=False),
+                              Column('kind', String(32), primary_key=True),
+                              Column('gitorious_id', Integer, primary_key=True, autoincrement=False),
+                              Column('step', String(32), primary_key=True),
+                              Column('gitlab_id', Integer, nullable=False))
+        metadata.create_all(self._engine)
+
+    def claim(self, project_id):
+        # CLAIMED for a new claim, TAKEN_OVER for an expired one, None when someone else holds the project
+        now = time.time()
+        try:
+            with self._engine.begin() as conn:
+                conn.execute(self._claims.insert().values(project_id=project_id, owner=self.owner,
+                                                          expires=now + self.ttl, status=CLAIMED))
+            return CLAIMED
+        except IntegrityError:
+            pass
+        # only a claim whose owner stopped renewing it can be taken over
+        c = self._claims.c
+        with self._engine.begin() as conn:
+            result = conn.execute(self._claims.update()
+                                  .where(and_(c.project_id == project_id, c.status == CLAIMED, c.expires < now))
+                                  .values(owner=self.owner, expires=now + self.ttl))
+        return TAKEN_OVER if result.rowcount == 1 else None
+
+    def record_created(self, project_id, kind, gitorious_id, step, gitlab_id):
+        c = self._created.c
+        with self._engine.begin() as conn:
+            conn.execute(self._created.delete().where(and_(c.project_id == project_id, c.kind == kind,
+                                                           c.gitorious_id == gitorious_id, c.step == step)))
+            conn.execute(self._created.insert().values(project_id=project_id, kind=kind, gitorious_id=gitorious_id,
+                                                       step=step, gitlab_id=gitlab_id))
+
+    def created(self, project_id):
+        c = self._created.c
+        with self._engine.connect() as conn:
+            return [(row.kind, row.gitorious_id, row.step, row.gitlab_id)
+                    for row in conn.execute(self._created.select().where(c.project_id == project_id))]
+
+    def complete(self, project_id, slug=None, error=None):
+        c = self._claims.c
+        with self._engine.begin() as conn:
+            conn.execute(self._claims.update()
+                         .where(and_(c.project_id == project_id, c.owner == self.owner))
+                         .values(status=DONE if error is None else FAILED, slug=slug, error=error))
+
+    def renew(self):
+        c = self._claims.c
+        with self._engine.begin() as conn:
+            conn.execute(self._claims.update()
+                         .where(and_(c.owner == self.owner, c.status == CLAIMED))
+                         .values(expires=time.time() + self.ttl))
+
+    @contextmanager
+    def heartbeat(self, interval=None):
+        # renews this owner's claims in the background, so long migrations do not look abandoned
+        stopped = threading.Event()
+        def beat():
+            while not stopped.wait(interval or self.ttl / 3.0):
+                self.renew()
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield self
+        finally:
+            stopped.set()
+            thread.join()
+
+    def unfinished(self, project_ids):
+        c = self._claims.c
+        with self._engine.connect() as conn:
+            finished = set(pid for (pid,) in conn.execute(select([c.project_id]).where(c.status != CLAIMED)))
+        return [pid for pid in project_ids if pid not in finished]
+
+    def failures(self):
+        c = self._claims.c
+        with self._engine.connect() as conn:
+            return [(row.project_id, row.slug, row.error)
+                    for row in conn.execute(self._claims.select().where(c.status == FAILED).order_by(c.project_id))]
+
+    def done_count(self):
+        c = self._claims.c
+        with self._engine.connect() as conn:
+            return conn.execute(select([func.count()]).select_from(self._claims).where(c.status == DONE)).scalar()
+
+    def clear(self):
+        with self._engine.begin() as conn:
+            conn.execute(self._created.delete())
+            conn.execute(self._claims.delete())
@@ -1,5 +1,8 @@
+import os.path as path
+import threading
+
 from sqlalchemy import create_engine, ForeignKey
-from sqlalchemy.orm import backref, relationship, sessionmaker, object_session
+from sqlalchemy.orm import backref, relationship, scoped_session, selectinload, sessionmaker, object_session
 
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, DateTime, Integer, String, Table
@@ -12,6 +15,25 @@ def setup_session(path_to_db):
     Session.configure(bind=engine)
     return Session()
 
+def setup_scoped_session(path_to_db):
+    # one session per thread; sessions are kept until remove() so that ORM objects
+    # handed back from worker threads stay attached
+    engine = create_engine('sqlite:///' + path_to_db, connect_args={'check_same_thread': False})
+    return scoped_session(sessionmaker(bind=engine), scopefunc=threading.get_ident)
+
+def load_index(session):
+    index = Index(session)
+    session.info['index'] = index
+    return index
+
+def _find(obj, type_name, obj_id):
+    session = object_session(obj)
+    index = session.info.get('index')
+    if index is not None:
+        return index.find(type_name, obj_id)
+    target = globals()[type_name]
+    return session.query(target).filter(target.id == obj_id).one_or_none()
+
 
 group_memberships = Table('memberships', Base.metadata,
     Column('id', Integer, primary_key=True),
@@ -108,8 +130,7 @@ class Project(Base):
 
     @property
     def owner(self):
-        target = globals()[self.owner_type]
-        return object_session(self).query(target).filter(target.id == self.owner_id).one_or_none()
+        return _find(self, self.owner_type, self.owner_id)
 
     slug = Column(String)
     title = Column(String)
@@ -145,8 +166,7 @@ class Repository(Base):
 
     @property
     def owner(self):
-        target = globals()[self.owner_type]
-        return object_session(self).query(target).filter(target.id == self.owner_id).one_or_none()
+        return _find(self, self.owner_type, self.owner_id)
 
     parent_id = Column(Integer, ForeignKey('repositories.id'))
     children = relationship('Repository', backref=backref('parent', remote_side=[id]))
@@ -162,6 +182,9 @@ class Repository(Base):
     def clone_url(self, server_url):
         return 'git://{}/{}/{}.git'.format(server_url, self.project.slug, self.name)
 
+    def local_path(self, repository_root):
+        return path.join(repository_root, self.hashed_path + '.git')
+
     def __repr__(self):
         return 'Repository(path={}, name={}, project={})'.format(self.hashed_path, self.name, repr(self.project))
 
@@ -176,8 +199,7 @@ class Committership(Base):
 
     @property
     def committer(self):
-        target = globals()[self.committer_type]
-        return object_session(self).query(target).filter(target.id == self.committer_id).one_or_none()
+        return _find(self, self.committer_type, self.committer_id)
 
     repository_id = Column(Integer, ForeignKey('repositories.id'))
     repository = relationship('Repository', back_populates='committerships')
@@ -196,4 +218,28 @@ class SshKey(Base):
     created_at = Column(DateTime)
     updated_at = Column(DateTime)
 
-User.ssh_keys = relationship('SshKey', back_populates='user')
\ No newline at end of file
+User.ssh_keys = relationship('SshKey', back_populates='user')
+
+
+class Index(object):
+    # Loads every modeled table in a handful of batched queries. Collections are populated
+    # eagerly and many-to-one references resolve from the identity map, which this object
+    # keeps alive, so walking the graph afterwards issues no further SQL.
+    def __init__(self, session):
+        self.sites = dict((s.id, s) for s in session.query(Site))
+        self.tags = dict((t.id, t) for t in session.query(Tag))
+        self.users = dict((u.id, u) for u in session.query(User).options(selectinload(User.ssh_keys)))
+        self.groups = dict((g.id, g) for g in session.query(Group).options(selectinload(Group.members)))
+        self.projects = dict((p.id, p) for p in session.query(Project).options(selectinload(Project.tags),
+                                                                               selectinload(Project.repositories)))
+        self.repositories = dict((r.id, r) for r in session.query(Repository).options(selectinload(Repository.committerships),
+                                                                                      selectinload(Repository.children)))
+        self._by_type = {
+            'User': self.users,
+            'Group': self.groups,
+            'Project': self.projects,
+            'Repository': self.repositories
+        }
+
+    def find(self, type_name, obj_id):
+        return self._by_type[type_name].get(obj_id)
@@ -1,16 +1,32 @@
+import functools
+import hashlib
 import os
 import os.path as path
+import queue
 import random
+import re
 import string
+import threading
+import time
 import urllib3
 
-from collections import defaultdict, namedtuple, OrderedDict
+from collections import defaultdict, deque, namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse, ParseResult
 
 import gitlab
+import gitlab.v4.objects
 import git
 
+from sqlalchemy.orm import selectinload
+
 import gitorious2gitlab.gitorious as gitorious
+from gitorious2gitlab.api import GitlabClient, ObjectCache
+from gitorious2gitlab.claims import shard_of, TAKEN_OVER
+from gitorious2gitlab.instrumentation import Instrumentation
+from gitorious2gitlab.workspace import Workspace
+from gitorious2gitlab.journal import MigrationJournal
+from gitorious2gitlab.profiling import Profiler
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -18,12 +34,52 @@ class UnmigratedRepositoryError(Exception):
     pass
 
 MigrationError = namedtuple('MigrationError', 'project, exception')
+# stands in for a gitorious.Project once its ORM state has been released
+ProjectRef = namedtuple('ProjectRef', 'id, slug')
 MigrationResult = namedtuple('MigrationResult', 'migrated_project_count, unmigrated_projects')
+ProvisioningError = namedtuple('ProvisioningError', 'user, key_index, exception')
+ProvisioningResult = namedtuple('ProvisioningResult', 'provisioned_user_count, unprovisioned_users, failed_keys')
+PreparedProject = namedtuple('PreparedProject', 'gl_project, transfers')
+Transfer = namedtuple('Transfer', 'repository, step, gitlab_id, local_path, source_url, target_url, reference')
+SyncResult = namedtuple('SyncResult', 'updated_repository_count, unchanged_repository_count, unsynced_projects')
+CleanupResult = namedtuple('CleanupResult', 'removed_count, remaining')
+
+def merge_results(results):
+    return MigrationResult(sum(r.migrated_project_count for r in results), [e for r in results for e in r.unmigrated_projects])
+
+MIRRORED_REFS = ('refs/heads/', 'refs/tags/')
+
+def ls_remote(url):
+    refs = dict()
+    for line in git.cmd.Git().ls_remote(url).splitlines():
+        (sha, ref) = line.split('\t')
+        if ref.startswith(MIRRORED_REFS) and not ref.endswith('^{}'):
+            refs[ref] = sha
+    return refs
+
+def refs_digest(refs):
+    return hashlib.sha1('\n'.join('{} {}'.format(sha, ref) for (ref, sha) in sorted(refs.items())).encode()).hexdigest()
+
+class PushProgress(git.RemoteProgress):
+    # git reports the size of the pack it sent at the end of the 'Writing objects' stage
+    UNITS = {'bytes': 1, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3}
+    SIZE = re.compile(r'([0-9.]+) (bytes|KiB|MiB|GiB)')
+
+    def __init__(self):
+        super().__init__()
+        self.bytes = 0
+
+    def update(self, op_code, cur_count, max_count=None, message=''):
+        match = self.SIZE.match(message or '')
+        if op_code & self.WRITING and match is not None:
+            self.bytes = int(float(match.group(1)) * self.UNITS[match.group(2)])
 
 class Repository(object):
-    def __init__(self, origin_url, local_path):
+    def __init__(self, origin_url, local_path, reference=None, instrumentation=None):
         self._origin_url = origin_url
         self._path = local_path
+        self._reference = reference
+        self._instrumentation = instrumentation or Instrumentation()
         self._create_repo()
 
     @property
@@ -31,14 +87,59 @@ class Repository(object):
         return self._repo
 
     def update(self):
-        self.repository.remotes['origin'].fetch('+refs/heads/*:refs/heads/*')
+        origin = self.repository.remotes['origin']
+        with origin.config_writer as cw:
+            cw.set('url', self._origin_url)
+        with self._instrumentation.timer('fetch'):
+            origin.fetch(['+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*'], prune=True)
+
+    def object_stats(self):
+        stats = dict()
+        for line in self.repository.git.count_objects('-v').splitlines():
+            (name, value) = line.split(':', 1)
+            if value.strip().isdigit():
+                stats[name] = int(value)
+        return stats
+
+    def repack(self, window=250, depth=50):
+        # a tight pack built with local CPU lets push reuse its deltas instead of computing new ones
+        args = ['-a', '-d', '-f', '--window={}'.format(window), '--depth={}'.format(depth)]
+        if path.exists(path.join(self.repository.git_dir, 'objects', 'info', 'alternates')):
+            # leave borrowed objects in the reference; bitmaps need every object in a single pack
+            args.append('-l')
+        else:
+            args.append('--write-bitmap-index')
+        with self._instrumentation.timer('repack'):
+            self.repository.git.repack(*args)
+
+    def refs(self):
+        refs = dict()
+        for line in self.repository.git.for_each_ref('--format=%(objectname) %(refname)', *MIRRORED_REFS).splitlines():
+            (sha, ref) = line.split(' ', 1)
+            refs[ref] = sha
+        return refs
 
     def _create_repo(self):
+        # cloned tells whether this mirror was created now or reused from an earlier run
+        self.cloned = False
         try:
             self._repo = git.Repo(self._path)
         except:
             if not path.exists(self._path):
                 os.makedirs(self._path)
+            with self._instrumentation.timer('clone'):
+                self._clone()
+            self.cloned = True
+            stats = self.object_stats()
+            self._instrumentation.count('cloned_objects', stats.get('count', 0) + stats.get('in-pack', 0))
+            self._instrumentation.count('cloned_bytes', 1024 * (stats.get('size', 0) + stats.get('size-pack', 0)))
+
+    def _clone(self):
+        if self._reference is not None:
+            # borrow objects from an existing local clone (objects/info/alternates); only the objects
+            # missing from it are downloaded, and pushes still send every object the remote needs
+            self._repo = git.Repo.clone_from(self._origin_url, self._path, bare=True, reference=path.abspath(self._reference))
+        else:
             self._repo = git.Repo.clone_from(self._origin_url, self._path, bare=True)
     
     def configure(self, section, **kwargs):
@@ -60,23 +161,75 @@ class Repository(object):
         
         with remote.config_writer as cw:
             cw.set('pushurl', remote_url)
-            cw.set('mirror', True)
-        
-        remote.push()
+            # a fetch refspec makes every push write refs/remotes/<remote>/*, which a mirror push sends on
+            for option in ('fetch', 'mirror'):
+                if cw.has_option(option):
+                    cw.remove_option(option)
+        self._remove_tracking_refs(remote)
+
+        progress = PushProgress()
+        with self._instrumentation.timer('push'):
+            remote.push(['+{0}*:{0}*'.format(ref) for ref in MIRRORED_REFS], progress=progress, prune=True)
+        self._instrumentation.count('pushed_bytes', progress.bytes)
+
+    def _remove_tracking_refs(self, remote):
+        # left behind by earlier mirror pushes, locally and on the other side
+        prefix = 'refs/remotes/{}/'.format(remote.name)
+        tracking = self.repository.git.for_each_ref('--format=%(refname)', prefix).splitlines()
+        if len(tracking) == 0:
+            return
+        remote.push([':' + ref for ref in tracking])
+        for ref in tracking:
+            self.repository.git.update_ref('-d', ref)
+
+class RepositoryGraph(object):
+    # id-indexed view of the repositories: parent -> children and project -> repositories
+    def __init__(self, repositories):
+        self.by_id = dict()
+        self.by_project = defaultdict(list)
+        self.children = defaultdict(list)
+        for repo in sorted(repositories, key=lambda r: r.id):
+            if repo.id in self.by_id:
+                continue
+            self.by_id[repo.id] = repo
+            self.by_project[repo.project_id].append(repo)
+            if repo.parent_id is not None:
+                self.children[repo.parent_id].append(repo)
+
+    def repositories(self, project):
+        return self.by_project[project.id]
+
+    def is_fork(self, repository):
+        return repository.parent_id is not None and repository.parent_id in self.by_id
+
+    def fork_tree(self, repository):
+        # every fork below repository, breadth first, so a parent always precedes its forks
+        forks = []
+        pending = deque([repository])
+        while len(pending) > 0:
+            children = [c for c in self.children[pending.popleft().id] if c.project_id == repository.project_id]
+            forks.extend(children)
+            pending.extend(children)
+        return forks
 
 class RepositoryGroup(namedtuple('ParsedRepos', 'project_repo, wiki_repo, forks')):
     @staticmethod
-    def from_project(gitorious_project: gitorious.Project):
-        project_repos = [r for r in gitorious_project.repositories if not r.name.endswith('-gitorious-wiki') and r.parent is None]
-        wiki_repos = OrderedDict((r.hashed_path[0:-15], r) for r in gitorious_project.repositories if r.name.endswith('-gitorious-wiki'))
-        forks = [r for r in gitorious_project.repositories if r.parent is not None]
+    def from_project(gitorious_project: gitorious.Project, graph: RepositoryGraph=None):
+        if graph is None:
+            repositories = list(gitorious_project.repositories)
+            graph = RepositoryGraph(repositories + [r.parent for r in repositories if r.parent_id is not None and r.parent is not None])
+        repositories = graph.repositories(gitorious_project)
+        project_repos = [r for r in repositories if not r.name.endswith('-gitorious-wiki') and not graph.is_fork(r)]
+        wiki_repos = OrderedDict((r.hashed_path[0:-15], r) for r in repositories if r.name.endswith('-gitorious-wiki'))
+        forks = [r for r in repositories if graph.is_fork(r)]
         
         if len(project_repos) > 0:
             num_wikis = len(wiki_repos)
             if num_wikis > 1:
                 print('{} has {} wikis!'.format(gitorious_project.slug, num_wikis))
             
-            wiki_is_mapped = all(any(w==r.hashed_path for r in project_repos) for w in wiki_repos.keys())
+            project_paths = set(r.hashed_path for r in project_repos)
+            wiki_is_mapped = all(w in project_paths for w in wiki_repos.keys())
             
             for repo in project_repos:
                 selected_wiki = None
@@ -88,7 +241,7 @@ class RepositoryGroup(namedtuple('ParsedRepos', 'project_repo, wiki_repo, forks'
                 if selected_wiki is not None:
                     num_wikis -= 1
                 
-                yield RepositoryGroup(repo, selected_wiki, [f for f in forks if f.parent is repo])
+                yield RepositoryGroup(repo, selected_wiki, graph.fork_tree(repo))
             if num_wikis > 0:
                 raise UnmigratedRepositoryError('{} wiki{}not migrated'.format(num_wikis, 's ' if num_wikis > 1 else ' '))
         elif len(forks) > 0:
@@ -107,13 +260,46 @@ def randomword(length):
     return ''.join(random.choice(string.ascii_letters) for i in range(length))
 
 class ImportSession(object):
-    def __init__(self, gitorious_db_conn, gitorious_url, gitlab_url, gitlab_token, username_formatter=str):
-        self._gitorious_session = gitorious.setup_session(gitorious_db_conn)
+    def __init__(self, gitorious_db_conn, gitorious_url, gitlab_url, gitlab_token, username_formatter=str, workers=1,
+                 journal_path=path.join('exported_repositories', 'journal.sqlite'), preload=True, repository_root=None,
+                 gitlab_pool_size=None, gitlab_retries=5, gitlab_timeout=60, cache_ttl=600, instrumentation=None,
+                 workspace_budget=None, workspace_policy='lru', repack=False, pipeline=True, member_batch_size=1,
+                 profile_dir=None, profile_threshold=300):
+        self._gitorious_session = gitorious.setup_scoped_session(gitorious_db_conn)
+        self.instrumentation = instrumentation or Instrumentation()
+        self.instrumentation.watch_engine(self._gitorious_session.get_bind())
+        if profile_dir is not None:
+            # projects running longer than profile_threshold seconds leave a profile in profile_dir
+            self.instrumentation.profiler = Profiler(profile_dir, profile_threshold)
+        self.preload = preload
         self._gitorious_url = gitorious_url
-        self._gitlab = gitlab.Gitlab(gitlab_url, private_token=gitlab_token, api_version=4, ssl_verify=False)
+        # when set, repositories are cloned straight from the Gitorious repository directory
+        self.repository_root = repository_root
+        self._gitlab = GitlabClient(gitlab_url, gitlab_token, pool_size=gitlab_pool_size or max(10, 2 * workers),
+                                    retries=gitlab_retries, timeout=gitlab_timeout, instrumentation=self.instrumentation,
+                                    api_version=4, ssl_verify=False)
+        self.cache = ObjectCache(cache_ttl)
+        # local mirrors live under exported_repositories, within workspace_budget bytes when set
+        self.workspace = Workspace('exported_repositories', workspace_budget, workspace_policy, self.instrumentation)
+        # repack mirrors before their first push, trading local CPU for upload bandwidth
+        self.repack = repack
+        # overlap the GitLab API work of the next repo group with the git transfers of the current one
+        self.pipeline = pipeline
+        self.member_batch_size = member_batch_size
         self.format_username = username_formatter
+        self.workers = workers
+        self.journal = MigrationJournal(journal_path)
         self.users = OrderedDict()
         self.gl_tokens = dict()
+        # gitorious user id -> gitlab user; worker threads load their own copies of gitorious.User
+        self._gitlab_users = dict()
+        self._token_lock = threading.Lock()
+        # the preloaded index and its repository graph are built once and only read by the workers
+        self._index = None
+        self._repository_graph = None
+        self._index_lock = threading.Lock()
+        # the claim store of a running migrate_shard
+        self._claims = None
     
     @property
     def gitorious(self):
@@ -127,12 +313,41 @@ class ImportSession(object):
     def gl(self):
         return self._gitlab
     
-    def map_existing_users(self):
-        gitorious_users = dict((self.format_username(u.login), u) for u in self.gitorious.query(gitorious.User))
-        gitlab_users = dict((u.username, u) for u in self.gl.users.list(all=True))
-
-        for username, user in gitorious_users.items():
-            self.users[user] = gitlab_users[username] if username in gitlab_users else None
+    def map_existing_users(self, workers=None, users=None):
+        workers = self.workers if workers is None else workers
+        known_users = self.journal.users()
+        unknown_users = []
+        for user in self.gitorious.query(gitorious.User) if users is None else users:
+            username = self.format_username(user.login)
+            entry = known_users.get(user.id)
+            if entry is not None and entry[0] == username:
+                self._map_user(user, self.gl.users.get(entry[1], lazy=True))
+            else:
+                unknown_users.append((user, username))
+
+        # users the index does not know yet are looked up one by one instead of listing every GitLab user
+        usernames = [username for (_, username) in unknown_users]
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                found = list(executor.map(self._find_gitlab_user, usernames))
+        else:
+            found = [self._find_gitlab_user(username) for username in usernames]
+
+        for ((user, username), gl_user) in zip(unknown_users, found):
+            self._map_user(user, gl_user)
+            if gl_user is not None:
+                self.journal.record_user(user, username, gl_user.id)
+
+    def _find_gitlab_user(self, username):
+        matches = [u for u in self.gl.users.list(username=username) if u.username == username]
+        return matches[0] if len(matches) > 0 else None
+
+    def _map_user(self, user, gl_user):
+        self.users[user] = gl_user
+        self._gitlab_users[user.id] = gl_user
+
+    def gitlab_user(self, user):
+        return self._gitlab_users[user.id]
 
     def wiki_url_for_project(self, project: gitlab.Project, include_auth=True) -> str:
         url = project.http_url_to_repo[0:-3] + 'wiki.git'
@@ -146,45 +361,109 @@ class ImportSession(object):
 
         return ParseResult(**parsed_url).geturl()
 
+    def source_url(self, repository):
+        if self.repository_root is not None:
+            # a plain local path lets git hardlink objects instead of transferring them
+            return repository.local_path(self.repository_root)
+        return repository.clone_url(self.gitorious_url)
+
     def make_local_path(self, project: gitlab.Project):
-        return path.join('exported_repositories', project.namespace['path'], project.path)
+        return path.join(self.workspace.root, project.namespace['path'], project.path)
     
-    def mirror(self, local_path, source_url, target_url):
-        repo = Repository(source_url, local_path)
-        repo.configure('http', proxy='', sslVerify=False)
-
-        repo.mirror('gitlab', target_url)
+    def mirror(self, local_path, source_url, target_url, reference=None):
+        with self.workspace.use(local_path, reference):
+            if reference is not None and not path.exists(reference):
+                reference = None
+            repo = Repository(source_url, local_path, reference, self.instrumentation)
+            repo.configure('http', proxy='', sslVerify=False)
+            if self.repack and repo.cloned:
+                repo.repack()
+
+            repo.mirror('gitlab', target_url)
+            # read while the mirror is pinned; the workspace may evict it as soon as it is released
+            return refs_digest(repo.refs())
+
+    def discard_pushed(self, pushed):
+        # with the after-push workspace policy, mirrors are removed once GitLab reports the pushed refs back
+        if not self.workspace.evict_after_push:
+            return
+        for (local_path, target_url, digest) in pushed:
+            if refs_digest(ls_remote(target_url)) == digest:
+                self.workspace.discard(local_path)
+            else:
+                print('\tkeeping {}: pushed refs could not be verified'.format(local_path))
     
-    def create_users(self):
-        self.map_existing_users()
+    def create_users(self, workers=None):
+        workers = self.workers if workers is None else workers
+        # only users and their keys: the full index is loaded by migrate_projects, and only when it does not stream
+        self.map_existing_users(workers, self.gitorious.query(gitorious.User).options(selectinload(gitorious.User.ssh_keys)))
         unmapped_users = [k for (k,v) in self.users.items() if v is None]
         print('{} users already mapped'.format(len([k for (k,v) in self.users.items() if v is not None])))
-        for user in unmapped_users:
-            try:
-                print(user)
-                self.users[user] = self.gl.users.create({
-                    'email': user.email,
-                    'username': self.format_username(user.login),
-                    'name': user.fullname,
-                    'password': randomword(12),
-                    'skip_confirmation': True
-                })
-                
-                i = 0
-                for key in user.ssh_keys:
-                    try:
-                        i+=1
-                        self.users[user].keys.create({
-                            'title': 'key {}'.format(i),
-                            'key': key.key
-                        })
-                    except gitlab.GitlabCreateError as key_error:
-                        print('\tproblem with key {}: {}'.format(i, key_error))
-            except gitlab.GitlabCreateError as user_error:
+
+        # workers only see plain key strings, never the (single-threaded) ORM session
+        jobs = [(user, [key.key for key in user.ssh_keys]) for user in unmapped_users]
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(self.provision_user, [u for (u, _) in jobs], [k for (_, k) in jobs]))
+        else:
+            results = [self.provision_user(user, keys) for (user, keys) in jobs]
+
+        unprovisioned_users = []
+        failed_keys = []
+        for ((user, keys), (gl_user, errors)) in zip(jobs, results):
+            if gl_user is None:
+                unprovisioned_users.extend(errors)
+                continue
+            self._map_user(user, gl_user)
+            self.journal.record_user(user, self.format_username(user.login), gl_user.id)
+            failed_keys.extend(errors)
+        self.instrumentation.finish('create_users')
+        return ProvisioningResult(len(jobs) - len(unprovisioned_users), unprovisioned_users, failed_keys)
+
+    def provision_user(self, user, keys):
+        print(user)
+        username = self.format_username(user.login)
+        try:
+            gl_user = self.gl.users.create({
+                'email': user.email,
+                'username': username,
+                'name': user.fullname,
+                'password': randomword(12),
+                'skip_confirmation': True
+            })
+            # only accounts created here are removed by a scoped remove_gitlab_users
+            self.journal.record(user, 'user', gl_user.id)
+            existing_keys = set()
+        except gitlab.GitlabCreateError as user_error:
+            # an interrupted run may already have created the account
+            gl_user = self._find_gitlab_user(username)
+            if gl_user is None:
                 print('\tproblem with user {}: {}'.format(user.login, user_error))
+                return (None, [ProvisioningError(user, None, user_error)])
+            existing_keys = set(k.key.strip() for k in gl_user.keys.list(all=True))
 
+        errors = []
+        for (i, key) in enumerate(keys, 1):
+            if key.strip() in existing_keys:
+                continue
+            try:
+                gl_user.keys.create({
+                    'title': 'key {}'.format(i),
+                    'key': key
+                })
+            except gitlab.GitlabCreateError as key_error:
+                print('\tproblem with key {}: {}'.format(i, key_error))
+                errors.append(ProvisioningError(user, i, key_error))
+        return (gl_user, errors)
 
     def create_project(self, repo_group, gitlab_project_root, **kwargs):
+        prepared = self.prepare_project(repo_group, gitlab_project_root, **kwargs)
+        self.transfer_project(prepared.transfers)
+        return prepared.gl_project
+
+    def prepare_project(self, repo_group, gitlab_project_root, **kwargs):
+        # Creates the GitLab project and its members. Iterating the returned transfers does the rest of the
+        # GitLab side (forks, fork relations, push tokens) and yields each git transfer once it can start.
         kwargs.update({
             'visibility': 'public',
             'name': repo_group.project_repo.name,
@@ -192,114 +471,382 @@ class ImportSession(object):
             'wiki_enabled': repo_group.wiki_repo is not None,
             'tag_list': [t.name for t in repo_group.project_repo.project.tags]
         })
-        project = gitlab_project_root.create(kwargs)
-        gl_project = self.gl.projects.get(project.id)
+        gl_project = self._journaled_project(repo_group.project_repo, gitlab_project_root, kwargs)
 
-        i = 0
-        for committer in (c.committer for c in repo_group.project_repo.committerships):
+        if not self.journal.done(repo_group.project_repo, 'members'):
             owner = repo_group.project_repo.owner if type(repo_group.project_repo.owner) is gitorious.User else repo_group.project_repo.owner.admin
-
-            if type(committer) is gitorious.User and owner is not committer:
-                gl_project.members.create({
-                    'user_id': self.users[committer].id,
-                    'access_level': gitlab.DEVELOPER_ACCESS
-                })
-                i += 1
-
-        if i > 0:
-            print('\tAdded {} committers'.format(i))
-        
-        # migrate the project repo
-        self.mirror(self.make_local_path(gl_project),
-                    repo_group.project_repo.clone_url(self.gitorious_url),
-                               self.make_authenticated_url(gl_project.http_url_to_repo, self.token(gl_project)))
-
-        # migrate the wiki
-        if repo_group.wiki_repo is not None:
-            self.mirror(self.make_local_path(gl_project) + '.wiki',
-                        repo_group.wiki_repo.clone_url(self.gitorious_url),
-                        self.wiki_url_for_project(gl_project))
-
+            committers = [self.gitlab_user(c).id for c in (c.committer for c in repo_group.project_repo.committerships)
+                          if type(c) is gitorious.User and c is not owner]
+            added = self._add_members(gl_project.members, committers, gitlab.DEVELOPER_ACCESS)
+            if added > 0:
+                print('\tAdded {} committers'.format(added))
+            self.journal.record(repo_group.project_repo, 'members')
+        return PreparedProject(gl_project, self._transfers(repo_group, gl_project))
+
+    def _transfers(self, repo_group, gl_project):
+        if not self.journal.done(repo_group.project_repo, 'repo'):
+            gl_project = self._loaded_project(gl_project)
+            yield Transfer(repo_group.project_repo, 'repo', gl_project.id, self.make_local_path(gl_project),
+                           self.source_url(repo_group.project_repo),
+                           self.make_authenticated_url(gl_project.http_url_to_repo, self.token(gl_project)), None)
+
+        if repo_group.wiki_repo is not None and not self.journal.done(repo_group.wiki_repo, 'wiki'):
+            gl_project = self._loaded_project(gl_project)
+            yield Transfer(repo_group.wiki_repo, 'wiki', gl_project.id, self.make_local_path(gl_project) + '.wiki',
+                           self.source_url(repo_group.wiki_repo), self.wiki_url_for_project(gl_project), None)
+
+        if any(not self.journal.done(f, 'repo') for f in repo_group.forks):
+            # forks are cloned against the project's local mirror
+            gl_project = self._loaded_project(gl_project)
+
+        # forks of forks are related to their direct parent
+        gitlab_ids = {repo_group.project_repo.id: gl_project.id}
         for fork in repo_group.forks:
-            gl_fork = self.users[fork.user].projects.create({
+            fork_project = self._journaled_project(fork, self.gitlab_user(fork.user).projects, {
                 'visibility': 'public',
                 'name': fork.name,
                 'description':  None if fork.description is None else fork.description[0:255],
                 'wiki_enabled': False
             })
-            fork_project = self.gl.projects.get(gl_fork.id)
-            fork_project.create_fork_relation(gl_project.id)
-
-            self.mirror(self.make_local_path(fork_project),
-                        fork.clone_url(self.gitorious_url),
-                        self.make_authenticated_url(fork_project.http_url_to_repo, self.token(fork_project)))
-        return gl_project
+            gitlab_ids[fork.id] = fork_project.id
+            if not self.journal.done(fork, 'fork_relation'):
+                try:
+                    fork_project.create_fork_relation(gitlab_ids.get(fork.parent_id, gl_project.id))
+                except gitlab.GitlabCreateError as ex:
+                    # already related by a host whose journal we do not have
+                    if ex.response_code != 409:
+                        raise
+                self.journal.record(fork, 'fork_relation')
+
+            if not self.journal.done(fork, 'repo'):
+                fork_project = self._loaded_project(fork_project)
+                yield Transfer(fork, 'repo', fork_project.id, self.make_local_path(fork_project), self.source_url(fork),
+                               self.make_authenticated_url(fork_project.http_url_to_repo, self.token(fork_project)),
+                               self.make_local_path(gl_project))
+
+    def transfer_project(self, transfers):
+        # forks borrow objects from the project's mirror, so nothing is discarded before the whole group is pushed
+        self.discard_pushed([self.transfer(t) for t in transfers])
+
+    def transfer(self, transfer):
+        digest = self.mirror(transfer.local_path, transfer.source_url, transfer.target_url, transfer.reference)
+        self.journal.record_refs(transfer.repository, digest)
+        self.journal.record(transfer.repository, transfer.step, transfer.gitlab_id)
+        return (transfer.local_path, transfer.target_url, digest)
 
     def create_group(self, project):
-        gitlab_group = self.gl.groups.create({
-            'visibility': 'public',
-            'name': project.title.replace('#', 'S'),
-            'path': project.slug,
-            'description': None if project.description is None else project.description[0:255]
-        })
-
-        owner = project.owner
-        if type(owner) is gitorious.Group:
-            for member in project.owner.members:
-                gitlab_group.members.create({
-                    'user_id': self.users[member].id,
-                    'access_level': gitlab.OWNER_ACCESS if member is owner.admin else gitlab.DEVELOPER_ACCESS
-                })
-        else: # owner is a user
-            gitlab_group.members.create({
-                'user_id': self.users[owner].id,
-                'access_level': gitlab.OWNER_ACCESS
+        group_id = self.journal.gitlab_id(project, 'group')
+        if group_id is None:
+            gitlab_group = self.gl.groups.create({
+                'visibility': 'public',
+                'name': project.title.replace('#', 'S'),
+                'path': project.slug,
+                'description': None if project.description is None else project.description[0:255]
             })
-        
+            self._share_created(project.id, project, 'group', gitlab_group.id)
+            self.journal.record(project, 'group', gitlab_group.id)
+        else:
+            gitlab_group = self.gl.groups.get(group_id, lazy=True)
+
+        if not self.journal.done(project, 'members'):
+            owner = project.owner
+            if type(owner) is gitorious.Group:
+                self._add_members(gitlab_group.members, [self.gitlab_user(owner.admin).id], gitlab.OWNER_ACCESS)
+                self._add_members(gitlab_group.members, [self.gitlab_user(m).id for m in owner.members if m is not owner.admin],
+                                  gitlab.DEVELOPER_ACCESS)
+            else: # owner is a user
+                self._add_member(gitlab_group.members, self.gitlab_user(owner).id, gitlab.OWNER_ACCESS)
+            self.journal.record(project, 'members')
+
         return gitlab_group
 
-    def migrate_projects(self):
-        unmigrated_projects = []
-        
-        migrated_projects_count = 0
-        for project in self.gitorious.query(gitorious.Project):
+    def migrate_project(self, project):
+        print(repr(project))
+        api_calls = self.gl.thread_call_count
+        if self.journal.done(project, 'migrated'):
+            print('\talready migrated')
+            return
+        repo_groups = list(RepositoryGroup.from_project(project, self.repository_graph()))
+        if type(project.owner) is gitorious.User and len(repo_groups) == 1:
+            gitlab_user = self.gitlab_user(project.owner)
+            api_calls -= self._pipeline([(repo_groups[0], gitlab_user.projects, {})])
+        else: # create a group
+            # 1. create parent group
+            gitlab_group = self.create_group(project)
+            api_calls -= self._pipeline([(repository, self.gl.projects, {'namespace_id': gitlab_group.id})
+                                         for repository in repo_groups])
+        self.journal.record(project, 'migrated')
+        print('\t{} API calls'.format(self.gl.thread_call_count - api_calls))
+
+    def _pipeline(self, jobs):
+        # A second thread does the GitLab side of the repo groups (projects, members, forks, tokens) and
+        # queues their git transfers, which run here as soon as they are ready, so pushes never wait for
+        # the API calls of the repositories behind them. Returns the API calls made on that thread.
+        if not self.pipeline:
+            for (repo_group, gitlab_project_root, kwargs) in jobs:
+                self._print_group(repo_group)
+                self.create_project(repo_group, gitlab_project_root, **kwargs)
+            return 0
+
+        ready = queue.Queue()
+        stopped = threading.Event()
+        def produce():
             try:
-                print(repr(project))
-                repo_groups = list(RepositoryGroup.from_project(project))
-                if type(project.owner) is gitorious.User and len(repo_groups) == 1:
-                    print('\t{} {} {} forks'.format(repo_groups[0].project_repo.hashed_path,
-                        'NO WIKI' if repo_groups[0].wiki_repo is None else repo_groups[0].wiki_repo.hashed_path,
-                        len(repo_groups[0].forks)))
-                    gitlab_user = self.users[project.owner]
-                    self.create_project(repo_groups[0], gitlab_user.projects)
-                else: # create a group
-                    # 1. create parent group
-                    gitlab_group = self.create_group(project)
-                    
-                    for repository in repo_groups:
-                        print('\t{} {} {} forks'.format(repository.project_repo.hashed_path,
-                                                'NO WIKI' if repository.wiki_repo is None else repository.wiki_repo.hashed_path,
-                                                len(repository.forks)))
-                        self.create_project(repository, self.gl.projects, namespace_id=gitlab_group.id)
-                migrated_projects_count += 1
+                for (repo_group, gitlab_project_root, kwargs) in jobs:
+                    ready.put(repo_group)
+                    for transfer in self.prepare_project(repo_group, gitlab_project_root, **kwargs).transfers:
+                        if stopped.is_set():
+                            return
+                        ready.put(transfer)
+                    ready.put(None)
             except Exception as ex:
-                print('ERROR: ' + repr(project) + str(ex))
-                unmigrated_projects.append(MigrationError(project, ex))
-        return MigrationResult(migrated_projects_count, unmigrated_projects)
-
-    def cleanup(self):
-        self.remove_gitlab_projects()
-        self.remove_gitlab_groups()
+                ready.put(ex)
 
-    def remove_gitlab_projects(self):
-        self._remove_gl('projects')
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            producer = executor.submit(self._on_behalf, self.instrumentation.current, produce)
+            try:
+                (groups, pushed) = (0, [])
+                while groups < len(jobs):
+                    item = ready.get()
+                    if isinstance(item, Exception):
+                        raise item
+                    elif type(item) is Transfer:
+                        pushed.append(self.transfer(item))
+                    elif item is None:
+                        self.discard_pushed(pushed)
+                        (groups, pushed) = (groups + 1, [])
+                    else:
+                        self._print_group(item)
+            finally:
+                stopped.set()
+        return producer.result()[1]
+
+    def _on_behalf(self, record, function, *args, **kwargs):
+        # charges timings and API calls made on a helper thread to the worker's project
+        calls = self.gl.thread_call_count
+        with self.instrumentation.bind(record):
+            result = function(*args, **kwargs)
+        return (result, self.gl.thread_call_count - calls)
+
+    def _print_group(self, repo_group):
+        print('\t{} {} {} forks'.format(repo_group.project_repo.hashed_path,
+                                        'NO WIKI' if repo_group.wiki_repo is None else repo_group.wiki_repo.hashed_path,
+                                        len(repo_group.forks)))
+
+    def migrate_projects(self, workers=None, plan=None, policy='largest-first', chunk_size=None):
+        # a plan (see planner.build_plan) fixes the order in which projects are handed to the workers
+        project_ids = None if plan is None else plan.project_ids(policy)
+        api_calls = self.gl.call_count
+        results = self._for_each_project(self.migrate_project, workers, project_ids, chunk_size)
+        unmigrated_projects = [r for r in results if type(r) is MigrationError]
+        print('{} gitorious queries, {} GitLab API calls'.format(self.instrumentation.counters['gitorious_queries'],
+                                                                 self.gl.call_count - api_calls))
+        self.instrumentation.finish('migrate_projects')
+        return MigrationResult(len(results) - len(unmigrated_projects), unmigrated_projects)
+
+    def migrate_shard(self, claims, shard_index=0, shard_count=1, workers=None, plan=None, policy='largest-first',
+                      poll_interval=None):
+        # This host starts with its own shard and then helps with the others, so projects claimed by a host
+        # that died are picked up once their claims expire. Returns what this host migrated; see
+        # shard_report for the result of all hosts together.
+        if plan is not None:
+            shards = plan.shards(shard_count, policy)
+        else:
+            shards = [[] for _ in range(shard_count)]
+            for (pid,) in self.gitorious.query(gitorious.Project.id).order_by(gitorious.Project.id):
+                shards[shard_of(pid, shard_count)].append(pid)
+        project_ids = [pid for shard in shards[shard_index:] + shards[:shard_index] for pid in shard]
+        workers = self.workers if workers is None else workers
+        self._ensure_index()
+
+        results = []
+        self._claims = claims
+        try:
+            with claims.heartbeat():
+                pending = claims.unfinished(project_ids)
+                while len(pending) > 0:
+                    attempts = self._parallel(functools.partial(self._migrate_claimed, claims), pending, workers)
+                    results.extend(r for r in attempts if r is not None)
+                    pending = claims.unfinished(pending)
+                    if len(pending) > 0 and all(r is None for r in attempts):
+                        # everything left is claimed by hosts that are still alive
+                        time.sleep(poll_interval or claims.ttl / 4.0)
+        finally:
+            self._claims = None
+        unmigrated_projects = [r for r in results if type(r) is MigrationError]
+        self.instrumentation.finish('migrate_shard')
+        return MigrationResult(len(results) - len(unmigrated_projects), unmigrated_projects)
+
+    def _migrate_claimed(self, claims, project_id):
+        claimed = claims.claim(project_id)
+        if claimed is None:
+            return None
+        if claimed == TAKEN_OVER:
+            # only what the previous owner recorded is reused; anything else already on GitLab stays a conflict
+            self.journal.record_steps(claims.created(project_id))
+        result = self._call_with_project(self.migrate_project, project_id)
+        if type(result) is MigrationError:
+            claims.complete(project_id, result.project.slug, str(result.exception))
+            return result
+        claims.complete(project_id)
+        return True
+
+    def shard_report(self, claims):
+        return MigrationResult(claims.done_count(), [MigrationError(ProjectRef(pid, slug), error)
+                                                     for (pid, slug, error) in claims.failures()])
+
+    def sync_project(self, project):
+        updated = unchanged = 0
+        for repository in project.repositories:
+            if not (self.journal.done(repository, 'repo') or self.journal.done(repository, 'wiki')):
+                continue
+            if self.sync_repository(repository):
+                updated += 1
+            else:
+                unchanged += 1
+        return (updated, unchanged)
+
+    def sync_repository(self, repository):
+        source_url = self.source_url(repository)
+        digest = refs_digest(ls_remote(source_url))
+        if digest == self.journal.refs_digest(repository):
+            return False
+
+        print('\tsyncing {}'.format(repr(repository)))
+        if self.journal.done(repository, 'wiki'):
+            gl_project = self._project(self.journal.gitlab_id(repository, 'wiki'))
+            local_path = self.make_local_path(gl_project) + '.wiki'
+            target_url = self.wiki_url_for_project(gl_project)
+        else:
+            gl_project = self._project(self.journal.gitlab_id(repository, 'repo'))
+            local_path = self.make_local_path(gl_project)
+            target_url = self.make_authenticated_url(gl_project.http_url_to_repo, self.token(gl_project))
+
+        with self.workspace.use(local_path, self.workspace.alternate(local_path)):
+            repo = Repository(source_url, local_path, instrumentation=self.instrumentation)
+            repo.update()
+            repo.mirror('gitlab', target_url)
+            digest = refs_digest(repo.refs())
+        self.journal.record_refs(repository, digest)
+        self.discard_pushed([(local_path, target_url, digest)])
+        return True
+
+    def sync(self, workers=None, chunk_size=None):
+        results = self._for_each_project(self.sync_project, workers, chunk_size=chunk_size)
+        unsynced_projects = [r for r in results if type(r) is MigrationError]
+        counts = [r for r in results if type(r) is not MigrationError]
+        self.instrumentation.finish('sync')
+        return SyncResult(sum(u for (u, _) in counts), sum(c for (_, c) in counts), unsynced_projects)
+
+    def _for_each_project(self, action, workers=None, project_ids=None, chunk_size=None):
+        # with a chunk_size, projects are streamed: ids are read chunk by chunk and every worker releases
+        # its ORM state after each project, so memory does not grow with the number of projects
+        workers = self.workers if workers is None else workers
+        call = functools.partial(self._call_with_project, action, release=chunk_size is not None)
+        if chunk_size is not None:
+            # streaming workers do not use an index loaded by an earlier run
+            with self._index_lock:
+                (self._index, self._repository_graph) = (None, None)
+            self._release_session()
+        else:
+            # loaded here rather than by a worker, whose thread (and session) ends with the pool
+            self._ensure_index()
+        results = []
+        for chunk in self._project_id_chunks(project_ids, chunk_size):
+            if workers > 1:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    results.extend(executor.map(call, chunk))
+            else:
+                results.extend(call(pid) for pid in chunk)
+        return results
+
+    def _project_id_chunks(self, project_ids=None, chunk_size=None):
+        if chunk_size is None:
+            if project_ids is None:
+                project_ids = [pid for (pid,) in self.gitorious.query(gitorious.Project.id).order_by(gitorious.Project.id)]
+            yield project_ids
+        elif project_ids is not None:
+            for i in range(0, len(project_ids), chunk_size):
+                yield project_ids[i:i + chunk_size]
+        else:
+            last_id = None
+            while True:
+                query = self.gitorious.query(gitorious.Project.id).order_by(gitorious.Project.id)
+                if last_id is not None:
+                    query = query.filter(gitorious.Project.id > last_id)
+                chunk = [pid for (pid,) in query.limit(chunk_size)]
+                self.gitorious.rollback()
+                if len(chunk) == 0:
+                    return
+                yield chunk
+                last_id = chunk[-1]
+
+    def repository_graph(self):
+        # built once from the preloaded index; without an index every project builds a graph from its
+        # own repositories
+        with self._index_lock:
+            if self._index is not None and self._repository_graph is None:
+                self._repository_graph = RepositoryGraph(self._index.repositories.values())
+            return self._repository_graph
+
+    def _ensure_index(self):
+        # Loaded into the session of the first thread that needs it. Everything the migration walks is
+        # loaded eagerly, so other threads can read these objects without that session running any SQL.
+        with self._index_lock:
+            if self.preload and self._index is None:
+                self._index = gitorious.load_index(self.gitorious)
+            return self._index
+
+    def _call_with_project(self, action, project_id, release=False):
+        # when streaming, or without an index, each worker loads the project in its own (thread-local) session
+        if release:
+            project = self.gitorious.query(gitorious.Project).options(
+                selectinload(gitorious.Project.tags),
+                selectinload(gitorious.Project.repositories).selectinload(gitorious.Repository.committerships)
+            ).get(project_id)
+        else:
+            index = self._ensure_index()
+            if index is not None:
+                project = index.projects[project_id]
+            else:
+                project = self.gitorious.query(gitorious.Project).get(project_id)
+        try:
+            with self.instrumentation.project(project, action.__name__):
+                return action(project)
+        except Exception as ex:
+            print('ERROR: ' + repr(project) + str(ex))
+            if release:
+                return MigrationError(ProjectRef(project.id, project.slug), str(ex))
+            return MigrationError(project, ex)
+        finally:
+            if release:
+                self._release_session()
+
+    def _release_session(self):
+        # closes this thread's session and its identity map; the next query opens a new one
+        self.gitorious.remove()
+
+    def cleanup(self, workers=None, scoped=True, timeout=600):
+        # projects go first so that group deletions do not have to cascade
+        projects = self.remove_gitlab_projects(workers, scoped, timeout)
+        if len(projects.remaining) > 0:
+            return projects
+        groups = self.remove_gitlab_groups(workers, scoped, timeout)
+        if len(groups.remaining) == 0:
+            self.journal.clear()
+        return CleanupResult(projects.removed_count + groups.removed_count, groups.remaining)
+
+    def remove_gitlab_projects(self, workers=None, scoped=True, timeout=600):
+        return self._remove_gl('projects', self.journal.gitlab_ids('project') if scoped else None, workers, timeout)
     
-    def remove_gitlab_groups(self):
-        self._remove_gl('groups')
+    def remove_gitlab_groups(self, workers=None, scoped=True, timeout=600):
+        return self._remove_gl('groups', self.journal.gitlab_ids('group') if scoped else None, workers, timeout)
     
-    def remove_gitlab_users(self):
-        for obj in filter(lambda x: x.id > 1, self.gl.users.list(all=True)):
-            self.gl.users.delete(obj.id)
+    def remove_gitlab_users(self, workers=None, scoped=True, timeout=600):
+        result = self._remove_gl('users', self.journal.gitlab_ids('user') if scoped else None, workers, timeout)
+        if len(result.remaining) == 0:
+            self.journal.clear_users()
+        return result
     
     def run(self, cleanup=False):
         self.create_users()
@@ -309,22 +856,128 @@ class ImportSession(object):
 
     def token(self, project: gitlab.Project) -> str:
         owner = self._get_project_owner(project)
-        if owner not in self.gl_tokens:
-            self.gl_tokens[owner] = owner.impersonationtokens.create({
-                'name': 'import token',
-                'scopes': ['api', 'read_user']
-            })
-        return self.gl_tokens[owner].token
+        with self._token_lock:
+            if owner.id not in self.gl_tokens:
+                with self.instrumentation.timer('token'):
+                    self.gl_tokens[owner.id] = owner.impersonationtokens.create({
+                        'name': 'import token',
+                        'scopes': ['api', 'read_user']
+                    })
+            return self.gl_tokens[owner.id].token
     
     def _get_project_owner(self, project: gitlab.Project) -> gitlab.User:
+        # only the id is needed to create impersonation tokens, so owners are never fetched
         if project.namespace['kind'] == 'user':
-            owner = self.gl.users.get(project.owner['id'])
-        else:# otherwise, project is owned by a group
-            group = self.gl.groups.get(project.namespace['id'])
-            owner = [self.gl.users.get(m.id) for m in group.members.list(access_level=gitlab.OWNER_ACCESS, all=True) if m.id > 1][0]
-        
-        return owner 
-    def _remove_gl(self, object_name):
+            return self.gl.users.get(project.owner['id'], lazy=True)
+        # otherwise, project is owned by a group
+        return self.cache.get('namespace_owner', project.namespace['id'], lambda: self._get_group_owner(project.namespace['id']))
+
+    def _get_group_owner(self, group_id):
+        group = self.gl.groups.get(group_id, lazy=True)
+        return [self.gl.users.get(m.id, lazy=True) for m in group.members.list(access_level=gitlab.OWNER_ACCESS, all=True) if m.id > 1][0]
+
+    def _project(self, project_id):
+        return self.cache.get('project', project_id, lambda: self.gl.projects.get(project_id))
+
+    def _journaled_project(self, repository, manager, data):
+        # projects recorded in the journal are returned lazily, without a request to the server
+        project_id = self.journal.gitlab_id(repository, 'project')
+        if project_id is not None:
+            return self.gl.projects.get(project_id, lazy=True)
+        # the creation response already describes the project, so there is no need to fetch it again
+        gl_project = gitlab.v4.objects.Project(self.gl.projects, manager.create(data).attributes)
+        self.cache.put('project', gl_project.id, gl_project)
+        self._share_created(repository.project_id, repository, 'project', gl_project.id)
+        self.journal.record(repository, 'project', gl_project.id)
+        return gl_project
+
+    def _share_created(self, project_id, obj, step, gitlab_id):
+        # during migrate_shard, the claim store keeps the ids of the GitLab objects created for a project,
+        # so a host that takes the project over reuses them instead of running into conflicts
+        if self._claims is not None:
+            self._claims.record_created(project_id, type(obj).__name__, obj.id, step, gitlab_id)
+
+    def _loaded_project(self, gl_project):
+        if hasattr(gl_project, 'http_url_to_repo'):
+            return gl_project
+        return self._project(gl_project.id)
+
+    def _add_members(self, members, user_ids, access_level):
+        # each user is added once; with member_batch_size > 1 several users share a request
+        # (comma separated user_id, GitLab 12.x and later), falling back to one request per user
+        user_ids = list(OrderedDict.fromkeys(user_ids))
+        size = max(1, self.member_batch_size)
+        for i in range(0, len(user_ids), size):
+            batch = user_ids[i:i + size]
+            if len(batch) > 1:
+                try:
+                    members.create({
+                        'user_id': ','.join(str(user_id) for user_id in batch),
+                        'access_level': access_level
+                    })
+                    continue
+                except gitlab.GitlabCreateError:
+                    pass
+            for user_id in batch:
+                self._add_member(members, user_id, access_level)
+        return len(user_ids)
+
+    def _add_member(self, members, user_id, access_level):
+        try:
+            members.create({
+                'user_id': user_id,
+                'access_level': access_level
+            })
+        except gitlab.GitlabCreateError as ex:
+            # a previous, interrupted run already added this member
+            if ex.response_code != 409:
+                raise
+
+    def _remove_gl(self, object_name, ids=None, workers=None, timeout=600):
+        # scoped removals only touch the ids recorded in the journal; otherwise everything but the admin goes
         glo = getattr(self.gl, object_name)
-        for obj in glo.list(all=True):
-            glo.delete(obj.id)
+        if ids is None:
+            ids = [obj.id for obj in glo.list(all=True) if object_name != 'users' or obj.id > 1]
+        workers = self.workers if workers is None else workers
+        print('removing {} {}'.format(len(ids), object_name))
+        self._parallel(functools.partial(self._delete_gl, glo), ids, workers)
+        remaining = self._await_removal(glo, ids, workers, timeout)
+        if len(remaining) > 0:
+            print('{} {} still present after {}s'.format(len(remaining), object_name, timeout))
+        return CleanupResult(len(ids) - len(remaining), [(object_name, i) for i in remaining])
+
+    def _await_removal(self, glo, ids, workers, timeout, interval=0.5):
+        # GitLab deletes projects, groups and users in background jobs; their names are only free once they are gone
+        deadline = time.monotonic() + timeout
+        remaining = list(ids)
+        while len(remaining) > 0:
+            exists = self._parallel(functools.partial(self._gl_exists, glo), remaining, workers)
+            remaining = [i for (i, e) in zip(remaining, exists) if e]
+            if len(remaining) == 0 or time.monotonic() >= deadline:
+                break
+            time.sleep(min(interval, max(0, deadline - time.monotonic())))
+            interval = min(2 * interval, 10)
+        return remaining
+
+    def _delete_gl(self, glo, obj_id):
+        try:
+            glo.delete(obj_id)
+        except gitlab.GitlabDeleteError as ex:
+            # already gone, or deleted by a group removal
+            if ex.response_code != 404:
+                raise
+
+    def _gl_exists(self, glo, obj_id):
+        try:
+            glo.get(obj_id)
+            return True
+        except gitlab.GitlabGetError as ex:
+            if ex.response_code != 404:
+                raise
+            return False
+
+    def _parallel(self, function, items, workers):
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                return list(executor.map(function, items))
+        return [function(item) for item in items]
@@ -0,0 +1,138 @@
+import json
+import threading
+import time
+
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+
+class Instrumentation(object):
+    # Collects run-wide totals and a record per project. Subclasses decide where records go by
+    # overriding emit(); the base class only aggregates.
+    def __init__(self):
+        self.timings = defaultdict(float)
+        self.counters = Counter()
+        self.projects = Counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # see profiling.Profiler
+        self.profiler = None
+
+    @property
+    def current(self):
+        return getattr(self._local, 'record', None)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.monotonic() - start)
+
+    def add_time(self, name, seconds):
+        record = self.current
+        with self._lock:
+            self.timings[name] += seconds
+            if record is not None:
+                record['timings'][name] = record['timings'].get(name, 0.0) + seconds
+        if record is not None and self.profiler is not None:
+            self.profiler.span(record, name, seconds)
+
+    def count(self, name, value=1):
+        record = self.current
+        with self._lock:
+            self.counters[name] += value
+            if record is not None:
+                record['counters'][name] = record['counters'].get(name, 0) + value
+
+    @contextmanager
+    def project(self, project, action):
+        record = {
+            'type': action,
+            'project_id': project.id,
+            'slug': project.slug,
+            'timings': dict(),
+            'counters': dict(),
+            # kept when a BaseException such as KeyboardInterrupt stops the project
+            'status': 'interrupted'
+        }
+        self._local.record = record
+        if self.profiler is not None:
+            self.profiler.begin(record)
+        start = time.monotonic()
+        try:
+            yield record
+            record['status'] = 'ok'
+        except Exception as ex:
+            record['status'] = 'error'
+            record['error'] = str(ex)
+            raise
+        finally:
+            record['seconds'] = time.monotonic() - start
+            self._local.record = None
+            if self.profiler is not None:
+                profile = self.profiler.end(record)
+                if profile is not None:
+                    record['profile'] = profile
+            with self._lock:
+                self.projects[record['status']] += 1
+            self.emit(record)
+
+    @contextmanager
+    def bind(self, record):
+        # lets a helper thread add to the record of the project it works for
+        previous = self.current
+        self._local.record = record
+        try:
+            yield record
+        finally:
+            if self.profiler is not None and record is not None:
+                self.profiler.detach(record)
+            self._local.record = previous
+
+    def finish(self, action):
+        with self._lock:
+            summary = {
+                'type': action + '_summary',
+                'projects': dict(self.projects),
+                'timings': dict(self.timings),
+                'counters': dict(self.counters)
+            }
+            self.timings.clear()
+            self.counters.clear()
+            self.projects.clear()
+        self.emit(summary)
+        return summary
+
+    def watch_engine(self, engine):
+        event.listen(engine, 'before_cursor_execute', self._before_query)
+        event.listen(engine, 'after_cursor_execute', self._after_query)
+
+    def emit(self, record):
+        pass
+
+    def _before_query(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.monotonic())
+
+    def _after_query(self, conn, cursor, statement, parameters, context, executemany):
+        self.add_time('gitorious_query', time.monotonic() - conn.info['query_start'].pop())
+        self.count('gitorious_queries')
+
+
+class JsonLinesInstrumentation(Instrumentation):
+    def __init__(self, path_to_file):
+        super().__init__()
+        self._file = open(path_to_file, 'a')
+        self._write_lock = threading.Lock()
+
+    def emit(self, record):
+        line = json.dumps(dict(record, time=time.time()), sort_keys=True)
+        with self._write_lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
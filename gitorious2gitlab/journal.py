@@ -0,0 +1,90 @@
+import os
+import os.path as path
+import sqlite3
+import threading
+
+
+class MigrationJournal(object):
+    def __init__(self, path_to_db):
+        directory = path.dirname(path_to_db)
+        if directory and not path.exists(directory):
+            os.makedirs(directory)
+        self._path = path_to_db
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path_to_db, check_same_thread=False)
+        with self._db:
+            self._db.execute('''CREATE TABLE IF NOT EXISTS steps (
+                                    kind TEXT NOT NULL,
+                                    gitorious_id INTEGER NOT NULL,
+                                    step TEXT NOT NULL,
+                                    gitlab_id INTEGER,
+                                    PRIMARY KEY (kind, gitorious_id, step))''')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS refs (
+                                    repository_id INTEGER PRIMARY KEY,
+                                    digest TEXT NOT NULL)''')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS users (
+                                    gitorious_id INTEGER PRIMARY KEY,
+                                    username TEXT NOT NULL,
+                                    gitlab_id INTEGER NOT NULL)''')
+
+    @property
+    def path(self):
+        return self._path
+
+    def done(self, obj, step):
+        return self._find(obj, step) is not None
+
+    def gitlab_id(self, obj, step):
+        row = self._find(obj, step)
+        return None if row is None else row[0]
+
+    def record(self, obj, step, gitlab_id=None):
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO steps (kind, gitorious_id, step, gitlab_id) VALUES (?, ?, ?, ?)',
+                             (type(obj).__name__, obj.id, step, gitlab_id))
+
+    def record_steps(self, steps):
+        # (kind, gitorious_id, step, gitlab_id) rows, e.g. from ClaimStore.created
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO steps (kind, gitorious_id, step, gitlab_id) VALUES (?, ?, ?, ?)',
+                                 steps)
+
+    def refs_digest(self, repository):
+        with self._lock:
+            row = self._db.execute('SELECT digest FROM refs WHERE repository_id = ?', (repository.id,)).fetchone()
+        return None if row is None else row[0]
+
+    def record_refs(self, repository, digest):
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO refs (repository_id, digest) VALUES (?, ?)', (repository.id, digest))
+
+    def users(self):
+        with self._lock:
+            return dict((gitorious_id, (username, gitlab_id))
+                        for (gitorious_id, username, gitlab_id) in self._db.execute('SELECT gitorious_id, username, gitlab_id FROM users'))
+
+    def record_user(self, user, username, gitlab_id):
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO users (gitorious_id, username, gitlab_id) VALUES (?, ?, ?)',
+                             (user.id, username, gitlab_id))
+
+    def gitlab_ids(self, step):
+        with self._lock:
+            return [gitlab_id for (gitlab_id,) in self._db.execute(
+                'SELECT DISTINCT gitlab_id FROM steps WHERE step = ? AND gitlab_id IS NOT NULL ORDER BY gitlab_id', (step,))]
+
+    def clear_users(self):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM users')
+            self._db.execute("DELETE FROM steps WHERE step = 'user'")
+
+    def clear(self):
+        # users outlive projects and groups, see clear_users
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM steps WHERE step != 'user'")
+            self._db.execute('DELETE FROM refs')
+
+    def _find(self, obj, step):
+        with self._lock:
+            return self._db.execute('SELECT gitlab_id FROM steps WHERE kind = ? AND gitorious_id = ? AND step = ?',
+                                    (type(obj).__name__, obj.id, step)).fetchone()
@@ -0,0 +1,180 @@
+import argparse
+import gzip
+import os
+import re
+import sqlite3
+import sys
+import time
+
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.schema import CreateTable
+
+import gitorious2gitlab.gitorious as gitorious
+
+# Streams a mysqldump of the Gitorious database into the SQLite file that gitorious.setup_session
+# reads. Only the tables and columns modeled in gitorious.py are kept; the dump is read one
+# statement (line) at a time, so memory depends on mysqldump's statement size, not on the dump.
+
+TABLES = gitorious.Base.metadata.tables
+# polymorphic references are not declared as foreign keys but are looked up just as often
+REFERENCE_COLUMNS = ('owner_id', 'committer_id')
+# rows of other models that share a modeled table
+ROW_FILTERS = {
+    'taggings': lambda row: row.get('taggable_type', 'Project') == 'Project'
+}
+
+CREATE_TABLE = re.compile(r'CREATE TABLE `([^`]+)`')
+COLUMN = re.compile(r'\s+`([^`]+)`')
+INSERT = re.compile(r'INSERT(?: IGNORE)? INTO `([^`]+)`(?: \(([^)]*)\))? VALUES ')
+TOKEN = re.compile(r"'((?:[^'\\]+|\\.|'')*)'|(NULL)|(0x[0-9A-Fa-f]*)|(_binary )|([-+0-9.eE]+)|([(),;])")
+ESCAPES = {'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t', 'Z': '\x1a'}
+ESCAPE = re.compile(r"\\(.)|''")
+ZERO_DATE = '0000-00-00'
+
+def unescape(value):
+    if '\\' not in value and "''" not in value:
+        return value
+    return ESCAPE.sub(lambda m: "'" if m.group(1) is None else ESCAPES.get(m.group(1), m.group(1)), value)
+
+def parse_rows(values):
+    # yields the tuples of an extended INSERT, e.g. (1,'a',NULL),(2,'b\'c',0x00)
+    row = None
+    for match in TOKEN.finditer(values):
+        # lastindex tells which alternative of TOKEN matched, see its groups
+        kind = match.lastindex
+        if kind == 6:
+            punctuation = match.group(6)
+            if punctuation == '(':
+                row = []
+            elif punctuation == ')':
+                yield row
+                row = None
+        elif row is None or kind == 4:
+            continue
+        elif kind == 1:
+            row.append(unescape(match.group(1)))
+        elif kind == 2:
+            row.append(None)
+        elif kind == 3:
+            row.append(bytes.fromhex(match.group(3)[2:]).decode('utf-8', 'replace'))
+        else:
+            number = match.group(5)
+            row.append(float(number) if any(c in number for c in '.eE') else int(number))
+
+def open_dump(path_to_dump):
+    if path_to_dump == '-':
+        return sys.stdin
+    if path_to_dump.endswith('.gz'):
+        return gzip.open(path_to_dump, 'rt', encoding='utf-8', errors='replace')
+    return open(path_to_dump, encoding='utf-8', errors='replace')
+
+
+class DumpLoader(object):
+    def __init__(self, path_to_db, batch_size=5000, transaction_size=500000):
+        self.path_to_db = path_to_db
+        self.batch_size = batch_size
+        self.transaction_size = transaction_size
+        self.counts = dict((name, 0) for name in TABLES)
+        self._dump_columns = dict()
+        self._pending = 0
+
+    def load(self, lines):
+        # builds a fresh database next to the target and only replaces it once everything is loaded
+        partial = self.path_to_db + '.partial'
+        if os.path.exists(partial):
+            os.remove(partial)
+        self._db = sqlite3.connect(partial)
+        self._db.execute('PRAGMA journal_mode = OFF')
+        self._db.execute('PRAGMA synchronous = OFF')
+        for table in TABLES.values():
+            self._db.execute(str(CreateTable(table).compile(dialect=sqlite.dialect())))
+        self._db.execute('BEGIN')
+
+        table_name = None
+        for line in lines:
+            if table_name is not None:
+                match = COLUMN.match(line)
+                if match is not None:
+                    self._dump_columns[table_name].append(match.group(1))
+                elif line.startswith(')'):
+                    table_name = None
+                continue
+            match = CREATE_TABLE.match(line)
+            if match is not None:
+                table_name = match.group(1)
+                self._dump_columns[table_name] = []
+                continue
+            match = INSERT.match(line)
+            if match is not None and match.group(1) in TABLES:
+                columns = self._dump_columns.get(match.group(1))
+                if match.group(2) is not None:
+                    columns = [c.strip(' `') for c in match.group(2).split(',')]
+                self._insert(TABLES[match.group(1)], columns, parse_rows(line[match.end():]))
+
+        self._db.commit()
+        self._create_indexes()
+        self._db.close()
+        os.replace(partial, self.path_to_db)
+        return self.counts
+
+    def _insert(self, table, dump_columns, rows):
+        if dump_columns is None:
+            raise ValueError('no column list for table {}'.format(table.name))
+        columns = [c.name for c in table.columns if c.name in dump_columns]
+        positions = [dump_columns.index(c) for c in columns]
+        dates = set(i for (i, c) in enumerate(columns) if str(table.columns[c].type) == 'DATETIME')
+        row_filter = ROW_FILTERS.get(table.name)
+        statement = 'INSERT OR REPLACE INTO {} ({}) VALUES ({})'.format(
+            table.name, ', '.join(columns), ', '.join('?' for _ in columns))
+
+        batch = []
+        for row in rows:
+            if row_filter is not None and not row_filter(dict(zip(dump_columns, row))):
+                continue
+            values = [row[p] for p in positions]
+            for i in dates:
+                # MySQL allows zero dates, which no datetime parser accepts
+                if values[i] is not None and values[i].startswith(ZERO_DATE):
+                    values[i] = None
+            batch.append(values)
+            if len(batch) >= self.batch_size:
+                self._flush(statement, batch, table.name)
+                batch = []
+        if len(batch) > 0:
+            self._flush(statement, batch, table.name)
+
+    def _flush(self, statement, batch, table_name):
+        self._db.executemany(statement, batch)
+        self.counts[table_name] += len(batch)
+        self._pending += len(batch)
+        if self._pending >= self.transaction_size:
+            self._db.commit()
+            self._db.execute('BEGIN')
+            self._pending = 0
+
+    def _create_indexes(self):
+        for table in TABLES.values():
+            for column in table.columns:
+                if len(column.foreign_keys) > 0 or column.name in REFERENCE_COLUMNS:
+                    self._db.execute('CREATE INDEX ix_{0}_{1} ON {0} ({1})'.format(table.name, column.name))
+        self._db.execute('ANALYZE')
+        self._db.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert a mysqldump of the Gitorious database into the SQLite source')
+    parser.add_argument('dump', help='mysqldump output, optionally gzipped; - reads stdin')
+    parser.add_argument('gitorious_db')
+    parser.add_argument('--batch-size', type=int, default=5000)
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    with open_dump(args.dump) as lines:
+        counts = DumpLoader(args.gitorious_db, args.batch_size).load(lines)
+    for (name, count) in sorted(counts.items()):
+        print('{:>16} {}'.format(name, count))
+    print('loaded in {:.1f}s'.format(time.monotonic() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+import argparse
+import heapq
+import json
+import os.path as path
+
+from collections import namedtuple
+
+import git
+
+import gitorious2gitlab.gitorious as gitorious
+from gitorious2gitlab.importer import RepositoryGraph, RepositoryGroup
+from gitorious2gitlab.workspace import directory_size
+
+PlanEntry = namedtuple('PlanEntry', 'project_id, slug, repository_count, cost, error')
+
+# default throughput assumptions used for the duration estimate; tune them from a benchmark or an earlier run
+BYTES_PER_SECOND = 5 * 1024 * 1024
+SECONDS_PER_REPOSITORY = 3.0
+
+def commit_count(directory):
+    return int(git.Repo(directory).git.rev_list('--all', '--count') or 0)
+
+def repository_cost(repository, repository_root=None, measure='size'):
+    if repository_root is None:
+        return 1
+    local_path = repository.local_path(repository_root)
+    if not path.exists(local_path):
+        return 0
+    if measure == 'commits':
+        return commit_count(local_path)
+    return directory_size(local_path)
+
+def build_plan(session, repository_root=None, measure='size'):
+    entries = []
+    graph = RepositoryGraph(session.query(gitorious.Repository))
+    for project in session.query(gitorious.Project).order_by(gitorious.Project.id):
+        error = None
+        try:
+            repo_groups = list(RepositoryGroup.from_project(project, graph))
+            repositories = [r for g in repo_groups for r in [g.project_repo, g.wiki_repo] + list(g.forks) if r is not None]
+        except Exception as ex:
+            error = str(ex)
+            repositories = graph.repositories(project)
+        cost = sum(repository_cost(r, repository_root, measure) for r in repositories)
+        entries.append(PlanEntry(project.id, project.slug, len(repositories), cost, error))
+    return Plan(entries, measure if repository_root is not None else 'repositories')
+
+
+class Plan(object):
+    POLICIES = {
+        'largest-first': lambda e: (-e.cost, e.project_id),
+        'smallest-first': lambda e: (e.cost, e.project_id),
+        'id': lambda e: e.project_id
+    }
+
+    def __init__(self, entries, measure='size'):
+        self.entries = list(entries)
+        self.measure = measure
+
+    def ordered(self, policy='largest-first'):
+        return sorted(self.entries, key=self.POLICIES[policy])
+
+    def project_ids(self, policy='largest-first'):
+        return [e.project_id for e in self.ordered(policy)]
+
+    def shards(self, count, policy='largest-first'):
+        # greedy balancing: each project goes to the shard with the least cost so far
+        loads = [(0, i) for i in range(count)]
+        shards = [[] for _ in range(count)]
+        for entry in self.ordered(policy):
+            (load, i) = heapq.heappop(loads)
+            shards[i].append(entry.project_id)
+            heapq.heappush(loads, (load + max(entry.cost, 1), i))
+        return shards
+
+    def entry_seconds(self, entry, bytes_per_second=BYTES_PER_SECOND, seconds_per_repository=SECONDS_PER_REPOSITORY):
+        transfer = entry.cost / float(bytes_per_second) if self.measure == 'size' else 0
+        return transfer + entry.repository_count * seconds_per_repository
+
+    def expected_seconds(self, workers=1, policy='largest-first', **rates):
+        # simulates the executor: each project goes to whichever worker frees up first
+        finish_times = [0.0] * max(1, workers)
+        for entry in self.ordered(policy):
+            heapq.heapreplace(finish_times, finish_times[0] + self.entry_seconds(entry, **rates))
+        return max(finish_times)
+
+    def save(self, path_to_file):
+        with open(path_to_file, 'w') as f:
+            json.dump({'measure': self.measure, 'entries': [e._asdict() for e in self.entries]}, f, indent=1)
+
+    @staticmethod
+    def load(path_to_file):
+        with open(path_to_file) as f:
+            data = json.load(f)
+        return Plan([PlanEntry(**e) for e in data['entries']], data['measure'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Plan a migration offline, without contacting GitLab')
+    parser.add_argument('gitorious_db')
+    parser.add_argument('plan_file')
+    parser.add_argument('--repository-root', help='Gitorious repository directory used to estimate costs')
+    parser.add_argument('--measure', choices=('size', 'commits'), default='size')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--policy', choices=sorted(Plan.POLICIES), default='largest-first')
+    args = parser.parse_args()
+
+    session = gitorious.setup_session(args.gitorious_db)
+    gitorious.load_index(session)
+    plan = build_plan(session, args.repository_root, args.measure)
+    plan.save(args.plan_file)
+    print('{} projects, {} repositories, total cost {} ({})'.format(len(plan.entries),
+        sum(e.repository_count for e in plan.entries), sum(e.cost for e in plan.entries), plan.measure))
+    print('expected duration with {} workers: {:.0f}s'.format(args.workers, plan.expected_seconds(args.workers, args.policy)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+import cProfile
+import json
+import os
+import os.path as path
+import pstats
+import threading
+import time
+
+
+class ProjectProfile(object):
+    def __init__(self, record):
+        self.record = record
+        self.start = time.monotonic()
+        self.spans = []
+        self.profiles = dict()
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+
+class Profiler(object):
+    # Keeps wall-clock spans (API calls, queries, clones, pushes...) for every running project and, once a
+    # project has run longer than threshold seconds, also a cProfile of each thread working on it. Only
+    # projects that end up over the threshold are saved, as <slug>-<id>-<action>.prof (pstats) and
+    # .spans.json; below it the cost is a list append per span.
+    def __init__(self, directory, threshold=300):
+        self.directory = directory
+        self.threshold = threshold
+        self._projects = dict()
+        self._lock = threading.Lock()
+
+    def begin(self, record):
+        with self._lock:
+            self._projects[id(record)] = ProjectProfile(record)
+
+    def detach(self, record):
+        # a helper thread stops working for the project
+        self._stop_thread(self._projects.get(id(record)))
+
+    def span(self, record, name, seconds):
+        project = self._projects.get(id(record))
+        if project is None:
+            return
+        end = time.monotonic() - project.start
+        project.spans.append((name, threading.current_thread().name, round(end - seconds, 6), round(seconds, 6)))
+        if end > self.threshold and threading.get_ident() not in project.profiles:
+            # cProfile only sees the thread that enables it, so every thread starts its own
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # another profiler already runs in this thread
+                profile = None
+            project.profiles[threading.get_ident()] = profile
+
+    def end(self, record):
+        with self._lock:
+            project = self._projects.pop(id(record), None)
+        if project is None:
+            return None
+        self._stop_thread(project)
+        if project.elapsed <= self.threshold:
+            return None
+        return self._save(project)
+
+    def _stop_thread(self, project):
+        if project is not None and project.profiles.get(threading.get_ident()) is not None:
+            project.profiles[threading.get_ident()].disable()
+
+    def _save(self, project):
+        record = project.record
+        if not path.exists(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        base = path.join(self.directory, '{}-{}-{}'.format(record['slug'], record['project_id'], record['type']))
+        profiles = [p for p in project.profiles.values() if p is not None and p.getstats()]
+        if len(profiles) > 0:
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(base + '.prof')
+        with open(base + '.spans.json', 'w') as f:
+            json.dump({
+                'project_id': record['project_id'],
+                'slug': record['slug'],
+                'action': record['type'],
+                'seconds': project.elapsed,
+                'threshold': self.threshold,
+                'timings': record['timings'],
+                'counters': record['counters'],
+                'spans': [dict(zip(('name', 'thread', 'start', 'seconds'), s)) for s in project.spans]
+            }, f, indent=1)
+        return base
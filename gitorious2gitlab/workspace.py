@@ -0,0 +1,150 @@
+import os
+import os.path as path
+import shutil
+import threading
+import time
+
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+from gitorious2gitlab.instrumentation import Instrumentation
+
+POLICIES = ('lru', 'after-push')
+
+def directory_size(directory):
+    total = 0
+    for (root, _, files) in os.walk(directory):
+        for name in files:
+            try:
+                total += os.lstat(path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class Workspace(object):
+    # Tracks the local mirrors under root and keeps their total size within budget bytes.
+    # Mirrors in use are pinned; everything else can be evicted, least recently used first.
+    # With the 'after-push' policy a mirror is also removed as soon as its push has been verified
+    # and nothing uses it anymore, so later syncs clone it again.
+    def __init__(self, root='exported_repositories', budget=None, policy='lru', instrumentation=None):
+        if policy not in POLICIES:
+            raise ValueError('unknown workspace policy {}'.format(policy))
+        self.root = root
+        self.budget = budget
+        self.policy = policy
+        self.instrumentation = instrumentation or Instrumentation()
+        self._sizes = OrderedDict()
+        self._pins = defaultdict(int)
+        self._dependents = defaultdict(set)
+        self._discarded = set()
+        self._condition = threading.Condition()
+        self._scan()
+
+    @property
+    def used(self):
+        return sum(self._sizes.values())
+
+    @property
+    def evict_after_push(self):
+        return self.policy == 'after-push'
+
+    @contextmanager
+    def use(self, local_path, reference=None):
+        # waits until the budget allows another mirror, then pins it (and the mirror it borrows objects from)
+        local_path = path.normpath(local_path)
+        paths = [local_path] if reference is None else [local_path, path.normpath(reference)]
+        with self._condition:
+            self._make_room(paths)
+            for p in paths:
+                self._pins[p] += 1
+            if reference is not None:
+                self._dependents[paths[1]].add(local_path)
+            self._discarded.discard(local_path)
+        try:
+            yield local_path
+        finally:
+            size = directory_size(local_path) if path.exists(local_path) else 0
+            with self._condition:
+                self._sizes[local_path] = size
+                self._sizes.move_to_end(local_path)
+                for p in paths:
+                    self._pins[p] -= 1
+                    if self._pins[p] == 0:
+                        del self._pins[p]
+                for p in list(self._discarded):
+                    if p in self._discarded and not self._in_use(p):
+                        self._evict(p)
+                self._shrink()
+                self._condition.notify_all()
+
+    def discard(self, local_path):
+        # the mirror is no longer needed; it is removed once the last user releases it
+        local_path = path.normpath(local_path)
+        with self._condition:
+            if self._in_use(local_path):
+                self._discarded.add(local_path)
+            else:
+                self._evict(local_path)
+            self._condition.notify_all()
+
+    def _make_room(self, pinning):
+        if self.budget is None:
+            return
+        start = time.monotonic()
+        while not self._shrink(pinning):
+            if len(set(self._pins) - set(pinning)) > 0:
+                # every tracked mirror is in use; wait for another worker to release one
+                self._condition.wait()
+            else:
+                break
+        self.instrumentation.add_time('workspace_wait', time.monotonic() - start)
+
+    def _shrink(self, pinning=()):
+        # evicts idle mirrors, least recently used first, until the workspace is below its budget
+        while self.budget is not None and self.used >= self.budget:
+            victim = next((p for p in self._sizes if not self._in_use(p) and p not in pinning), None)
+            if victim is None:
+                return False
+            self._evict(victim)
+        return True
+
+    def _in_use(self, local_path):
+        # a mirror is in use while it, or any mirror borrowing objects from it, is pinned
+        return local_path in self._pins or any(self._in_use(d) for d in self._dependents.get(local_path, ()))
+
+    def _evict(self, local_path):
+        if self._in_use(local_path):
+            return
+        # mirrors cloned with --reference cannot outlive the mirror they borrow objects from
+        for dependent in self._dependents.pop(local_path, ()):
+            self._evict(dependent)
+        size = self._sizes.pop(local_path, 0)
+        self._discarded.discard(local_path)
+        shutil.rmtree(local_path, ignore_errors=True)
+        self.instrumentation.count('evicted_mirrors')
+        self.instrumentation.count('evicted_bytes', size)
+
+    def _scan(self):
+        # mirrors left by an earlier run, laid out as root/namespace/project
+        if not path.isdir(self.root):
+            return
+        for namespace in sorted(os.listdir(self.root)):
+            namespace_dir = path.join(self.root, namespace)
+            if not path.isdir(namespace_dir):
+                continue
+            for name in sorted(os.listdir(namespace_dir)):
+                local_path = path.normpath(path.join(namespace_dir, name))
+                if path.isdir(local_path):
+                    self._sizes[local_path] = directory_size(local_path)
+                    reference = self.alternate(local_path)
+                    if reference is not None:
+                        self._dependents[reference].add(local_path)
+
+    def alternate(self, local_path):
+        alternates = path.join(local_path, 'objects', 'info', 'alternates')
+        if not path.exists(alternates):
+            return None
+        with open(alternates) as f:
+            line = f.readline().strip()
+        return path.normpath(path.relpath(path.dirname(line))) if len(line) > 0 else None